@@ -1,7 +1,12 @@
 import os
 import socket
 import struct
+import collections
+import threading
 import logging
+from jtag_common import JtagClientException, ClientHelpers, exclusive
+from sharedbuf import SharedBuffer, SHARED_BUFFER_SIZE, SHARED_SLOT, SHARED_THRESHOLD
+from daemons import find_daemon
 
 # create logger
 logger = logging.getLogger('JTAG')
@@ -16,6 +21,12 @@ ECP_PROGFLASH = 0xCC22
 ECP_READ_ID = 0xCC23
 ECP_UNIQUE_ID = 0xCC24
 ECP_CLEARFPGA = 0xCC25
+# Background SPI mode: the FPGA is cleared and the SPI flash is connected to
+# JTAG; a transfer is <length, read length> and the data to send, the reply
+# holds the bytes read. ECP_REFRESH boots the FPGA from the flash again.
+ECP_SPI_BACKGROUND = 0xCC26
+ECP_SPI_TRANSFER = 0xCC27
+ECP_REFRESH = 0xCC28
 
 USER_READ_ID = 0xCC01
 USER_READ_MEMORY = 0xCC02
@@ -29,6 +40,32 @@ USER_RUN_APPL = 0xCC09
 USER_READ_DEBUG = 0xCC0A
 USER_READ_CONSOLE2 = 0xCC0B
 
+# Pipelined requests: USER_TAGGED, a 16-bit tag and then any other request.
+# The reply is <code, op, tag, length> followed by the reply of that request.
+USER_TAGGED = 0xCC42
+# Scatter/gather: a count and then <kind, addr, length> per entry, followed
+# by the data for writes. The reply is <code, op, 0, length> and the data of
+# all reads, concatenated.
+USER_BATCH = 0xCC43
+
+# Bulk data through a buffer shared with the daemon: the client sends the size
+# and path of the buffer once, after that only <addr, offset, length>. The
+# buffer is used as a ring of slots; a large transfer is split over the slots
+# and sent as tagged requests, such that the daemon works on one slot while
+# the client fills or empties the next.
+USER_ATTACH_BUFFER = 0xCC44
+USER_WRITE_MEMORY_SHARED = 0xCC45
+USER_READ_MEMORY_SHARED = 0xCC46
+
+# Flash programming through the SPI master of the test FPGA, as ECP_PROGFLASH
+# but without clearing the FPGA; it needs the tester bitstream to be loaded.
+USER_PROG_FLASH_SPI = 0xCC47
+
+BATCH_READ_MEMORY = 1
+BATCH_WRITE_MEMORY = 2
+BATCH_READ_IO = 3
+BATCH_WRITE_IO = 4
+
 CODE_OKAY = 0x00
 CODE_BAD_SYNC = 0xEE
 CODE_UNKNOWN_COMMAND = 0xED
@@ -38,20 +75,57 @@ CODE_VERIFY_ERROR = 0xEA
 CODE_FIFO_ERROR = 0xE9
 CODE_PROGRESS = 0xBF
 
-class JtagClientException(Exception):
-    pass
-
-class JtagClient:
-    def __init__(self, host, port):
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+CONNECT_TIMEOUT = 1.0 # seconds, to connect and for the daemon to answer DAEMON_ID
+
+def io_batch(ops):
+    return [ (BATCH_READ_IO, addr, data) if isinstance(data, int) else (BATCH_WRITE_IO, addr, data) for (addr, data) in ops ]
+
+class PendingReply:
+    """Reply to a tagged request. The reply is only taken from the socket when the result is asked for."""
+    def __init__(self, client, tag, decode):
+        self.client = client
+        self.tag = tag
+        self.decode = decode
+
+    def result(self):
+        return self.decode(self.client.collect(self.tag))
+
+class JtagClient(ClientHelpers):
+    def __init__(self, host = None, port = None, interface = 1, serial = None, timeout = CONNECT_TIMEOUT, shared = True):
+        """Connects to the daemon at host:port, or, without a port, to the daemon that serves the given
+           FTDI interface (1 = A, 2 = B) according to the daemon registry. With 'shared', bulk data goes
+           through shared memory when the daemon runs on this machine."""
+        self.next_tag = 0
+        self.in_flight = collections.deque() # tags of which the reply is still in the socket
+        self.replies = {} # replies received, by tag
+        self.shared = None
+        self.fifo = b'' # I/O read data of user_queue_io, until read_fifo takes it
+        self.lock = threading.RLock()
+        self.pump = None
+        self.registers = None
+        self.flash_callback = None
+        if port is None:
+            endpoint = find_daemon(interface, serial)
+            if not endpoint:
+                raise JtagClientException(f"No JTAG daemon registered for interface {interface}")
+            (host, port) = endpoint
         self.port = port
-        for i in range(20):
+        logger.info(f"Connecting to daemon at {host}:{port}")
+        try:
+            self.sock = socket.create_connection((host or 'localhost', port), timeout)
+        except OSError as e:
+            raise JtagClientException(f"Can't connect to JTAG daemon at {host}:{port}: {e}")
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.check_daemon(timeout)
+        except (JtagClientException, OSError):
+            self.sock.close()
+            raise
+        if shared and self.sock.getpeername()[0] in ('127.0.0.1', '::1'):
             try:
-                logger.info(f"Trying to connect to port {self.port}")
-                self.sock.connect((host, self.port))
-                break
-            except ConnectionRefusedError:
-                self.port += 1
+                self.attach_shared_buffer()
+            except (JtagClientException, OSError) as e:
+                logger.warning(f"No shared buffer, bulk data goes through the socket: {e}")
 
     def errorstring(self, b):
         errors = { 0x00: 'OKAY',
@@ -65,26 +139,77 @@ class JtagClient:
             return errors[b]
         return 'Unknown Error {0:02x}'.format(b)
 
-    def check_daemon(self):
+    def check_reply(self, ret, message):
+        if ret[0] != 0:
+            raise JtagClientException(message + ": " + self.errorstring(ret[0]))
+        return ret
+
+    def send_command(self, opcode):
+        # The replies to tagged requests come first; take them from the socket before waiting for another reply
+        if self.in_flight:
+            self.drain()
+        self.sock.sendall(struct.pack(">H", opcode))
+
+    @exclusive
+    def submit(self, request, decode):
+        """Sends a request (opcode and parameters) without waiting for the reply. Returns a PendingReply."""
+        tag = self.next_tag
+        self.next_tag = (tag + 1) & 0xFFFF
+        self.sock.sendall(struct.pack(">HH", USER_TAGGED, tag) + request)
+        self.in_flight.append(tag)
+        return PendingReply(self, tag, decode)
+
+    def receive_tagged(self):
+        ret = self.sock.recv(8, socket.MSG_WAITALL)
+        if len(ret) < 8:
+            raise JtagClientException("Daemon closed the connection")
+        (code, op, tag, length) = struct.unpack("<BBHL", ret)
+        if code != 0 or op != (USER_TAGGED & 0xFF) or tag not in self.in_flight:
+            raise JtagClientException("Tagged reply out of sync: " + ret.hex())
+        self.replies[tag] = self.sock.recv(length, socket.MSG_WAITALL) if length else b''
+        self.in_flight.remove(tag)
+
+    @exclusive
+    def collect(self, tag):
+        while tag not in self.replies:
+            if tag not in self.in_flight:
+                raise JtagClientException(f"No reply pending for tag {tag}")
+            self.receive_tagged()
+        return self.replies.pop(tag)
+
+    def drain(self):
+        while self.in_flight:
+            self.receive_tagged()
+
+    @exclusive
+    def check_daemon(self, timeout = CONNECT_TIMEOUT):
+        self.sock.settimeout(timeout)
         try:
-            self.sock.sendall(struct.pack(">H", DAEMON_ID))
-        except BrokenPipeError as e:
+            self.send_command(DAEMON_ID)
+            ret = self.sock.recv(4, socket.MSG_WAITALL) # Expect 4 bytes back
+        except socket.timeout:
+            raise JtagClientException(f"Daemon did not answer within {timeout} s")
+        except OSError as e:
             raise JtagClientException(str(e))
-
-        ret = self.sock.recv(4, socket.MSG_WAITALL) # Expect 4 bytes back
+        finally:
+            self.sock.settimeout(None)
+        if len(ret) < 4:
+            raise JtagClientException("Daemon closed the connection")
         if ret[0] != CODE_OKAY or ret[1] != (DAEMON_ID & 0xFF):
             raise JtagClientException("Daemon fault! " + str(ret.hex()) + self.errorstring(ret[0]))
 
+    @exclusive
     def ecp_read_id(self):
-        self.sock.sendall(struct.pack(">H", ECP_READ_ID))
+        self.send_command(ECP_READ_ID)
         ret = self.sock.recv(8, socket.MSG_WAITALL) # Expect 8 bytes back
         if ret[0] == 0:
             (_, id) = struct.unpack("<LL", ret)
             return id
         raise JtagClientException("Failed to read FPGA ID: " + self.errorstring(ret[0]))
 
+    @exclusive
     def ecp_read_unique_id(self):
-        self.sock.sendall(struct.pack(">H", ECP_UNIQUE_ID))
+        self.send_command(ECP_UNIQUE_ID)
         ret = self.sock.recv(12, socket.MSG_WAITALL) # Expect 12 bytes back
         if ret[0] == 0:
             (_, code) = struct.unpack("<LQ", ret)
@@ -101,24 +226,56 @@ class JtagClient:
             return (code, lot, wafer, x, y, e)
         raise JtagClientException("Failed to read FPGA Unique Identity: " + self.errorstring(ret[0]))
 
+    @exclusive
     def ecp_clear_fpga(self):
-        self.sock.sendall(struct.pack(">H", ECP_CLEARFPGA))
+        self.send_command(ECP_CLEARFPGA)
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("Failed to clear FPGA: " + self.errorstring(ret[0]))
 
+    @exclusive
     def ecp_load_fpga(self, name):
+        if self.in_flight:
+            self.drain()
         self.sock.sendall(struct.pack(">HLB", ECP_LOADFPGA, 0, len(name)))
         self.sock.sendall(name.encode())
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("Failed to configure FPGA: " + self.errorstring(ret[0]))
 
-    def ecp_prog_flash(self, name, addr):
+    @exclusive
+    def ecp_enter_spi_background(self):
+        # The console fifos are gone with the design
+        self.stop_console_pump()
+        if self.registers:
+            self.registers.invalidate()
+        self.send_command(ECP_SPI_BACKGROUND)
+        ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
+        if ret[0] != 0:
+            raise JtagClientException("Failed to enter background SPI mode: " + self.errorstring(ret[0]))
+
+    @exclusive
+    def ecp_spi_transfer(self, data, read_length = 0):
+        self.send_command(ECP_SPI_TRANSFER)
+        self.sock.sendall(struct.pack("<LL", len(data), read_length) + bytes(data))
+        ret = self.sock.recv(2 + read_length, socket.MSG_WAITALL)
+        if ret[0] != 0:
+            raise JtagClientException("SPI transfer failed: " + self.errorstring(ret[0]))
+        return ret[2:]
+
+    @exclusive
+    def ecp_refresh(self):
+        self.send_command(ECP_REFRESH)
+        ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
+        if ret[0] != 0:
+            raise JtagClientException("Failed to refresh FPGA: " + self.errorstring(ret[0]))
+
+    @exclusive
+    def prog_flash(self, opcode, name, addr):
         file_size = os.stat(name)
         logger.info(f"Size of file: {file_size.st_size} bytes")
         pages = (file_size.st_size + 1023) // 1024 #Callback for every 1 KB
-        self.sock.sendall(struct.pack(">H", ECP_PROGFLASH))
+        self.send_command(opcode)
         self.sock.sendall(struct.pack("<LB", addr, len(name)))
         self.sock.sendall(name.encode())
         prog = 0
@@ -136,16 +293,24 @@ class JtagClient:
         if ret[0] != 0:
             raise JtagClientException("Failed to program Flash: " + self.errorstring(ret[0]))
 
+    def ecp_prog_flash(self, name, addr):
+        self.prog_flash(ECP_PROGFLASH, name, addr)
+
+    def user_prog_flash_spi(self, name, addr):
+        self.prog_flash(USER_PROG_FLASH_SPI, name, addr)
+
+    @exclusive
     def user_read_id(self):
-        self.sock.sendall(struct.pack(">H", USER_READ_ID))
+        self.send_command(USER_READ_ID)
         ret = self.sock.recv(8, socket.MSG_WAITALL) # Expect 8 bytes back
         if ret[0] == 0:
             (_, id) = struct.unpack("<LL", ret)
             return id
         raise JtagClientException("Failed to read User JTAG ID: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_read_debug(self):
-        self.sock.sendall(struct.pack(">H", USER_READ_DEBUG))
+        self.send_command(USER_READ_DEBUG)
         ret = self.sock.recv(8, socket.MSG_WAITALL) # Expect 8 bytes back
         if ret[0] == 0:
             (_, dbg) = struct.unpack("<LL", ret)
@@ -153,61 +318,53 @@ class JtagClient:
             return dbg
         raise JtagClientException("Failed to read User Debug Register: " + self.errorstring(ret[0]))
 
-    def user_read_console(self, do_print = False):
-        self.sock.sendall(struct.pack(">H", USER_READ_CONSOLE))
-        ret = self.sock.recv(4, socket.MSG_WAITALL) # Expect 4 bytes back with length info
-        (err, _, len) = struct.unpack("<BBH", ret)
-        ret = self.sock.recv(len, socket.MSG_WAITALL)
-        if err != 0:
-            raise JtagClientException("Failed to read Console Text: " + self.errorstring(ret[0]))
-
-        if do_print:
-            print(ret.decode(encoding='cp1252'))
-        return ret.decode(encoding='cp1252')
-
-    def user_read_console2(self, do_print = False):
-        self.sock.sendall(struct.pack(">H", USER_READ_CONSOLE2))
+    @exclusive
+    def read_console_fifo(self, console = 1):
+        # The daemon returns the console as decoded text; decoding it again does not change it
+        self.send_command(USER_READ_CONSOLE if console == 1 else USER_READ_CONSOLE2)
         ret = self.sock.recv(4, socket.MSG_WAITALL) # Expect 4 bytes back with length info
         (err, _, len) = struct.unpack("<BBH", ret)
         ret = self.sock.recv(len, socket.MSG_WAITALL)
         if err != 0:
-            raise JtagClientException("Failed to read Console Text: " + self.errorstring(ret[0]))
-
-        if do_print:
-            logger.info(ret.decode(encoding='cp1252'))
-        return ret.decode(encoding='cp1252')
+            raise JtagClientException("Failed to read Console Text: " + self.errorstring(err))
+        return ret
 
+    @exclusive
     def user_upload(self, name, addr):
-        self.sock.sendall(struct.pack(">H", USER_UPLOAD))
+        self.send_command(USER_UPLOAD)
         self.sock.sendall(struct.pack("<LB", addr, len(name)))
         self.sock.sendall(name.encode())
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("User file upload failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_run_app(self, addr):
-        self.sock.sendall(struct.pack(">H", USER_RUN_APPL))
+        self.send_command(USER_RUN_APPL)
         self.sock.sendall(struct.pack("<L", addr))
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("User Run Application failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_set_io(self, value):
-        self.sock.sendall(struct.pack(">H", USER_SET_IO))
+        self.send_command(USER_SET_IO)
         self.sock.sendall(struct.pack("<L", value))
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("User Set JTAG I/O failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_write_int32(self, addr, value):
-        self.sock.sendall(struct.pack(">H", USER_WRITE_MEMORY))
+        self.send_command(USER_WRITE_MEMORY)
         self.sock.sendall(struct.pack("<LLi", addr, 4, value))
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("JTAG Write memory failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_read_int32(self, addr):
-        self.sock.sendall(struct.pack(">H", USER_READ_MEMORY))
+        self.send_command(USER_READ_MEMORY)
         self.sock.sendall(struct.pack("<LL", addr, 1))
         ret = self.sock.recv(6, socket.MSG_WAITALL) # Expect 6 bytes back
         (val,) = struct.unpack("<i", ret[2:])
@@ -215,40 +372,175 @@ class JtagClient:
             raise JtagClientException("JTAG Read memory failed: " + self.errorstring(ret[0]))
         return val
 
+    @exclusive
+    def attach_shared_buffer(self, size = SHARED_BUFFER_SIZE):
+        """Sets up a buffer shared with the daemon, through which large memory reads and writes go from then on."""
+        shared = SharedBuffer.create(size)
+        try:
+            path = shared.path.encode()
+            self.send_command(USER_ATTACH_BUFFER)
+            self.sock.sendall(struct.pack("<LB", size, len(path)) + path)
+            ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
+        finally:
+            # Both sides have it mapped (or the daemon never will); the file itself is no longer needed
+            shared.unlink()
+        if ret[0] != 0:
+            shared.close()
+            raise JtagClientException("Attaching shared buffer failed: " + self.errorstring(ret[0]))
+        if self.shared:
+            self.shared.close()
+        self.shared = shared
+
+    @exclusive
+    def shared_transfer(self, opcode, addr, length, fill = None, empty = None, message = ''):
+        """Transfers 'length' bytes through the slots of the shared buffer, in pipelined requests.
+           fill(offset, slot) puts the data of a write in a slot before it is sent, and empty(offset, slot)
+           takes the data of a read from a slot once the daemon has filled it."""
+        size = min(SHARED_SLOT, self.shared.size) & ~3 # reads are in words
+        slots = self.shared.size // size
+        busy = collections.deque() # (reply, offset, slot view) in order of sending
+        def check(ret):
+            self.check_reply(ret, message)
+        def finish():
+            (reply, offset, view) = busy.popleft()
+            reply.result()
+            if empty:
+                empty(offset, view)
+            view.release()
+        for (n, offset) in enumerate(range(0, length, size)):
+            now = min(size, length - offset)
+            # The slot is free again once the reply to the request that used it last is in
+            if len(busy) == slots:
+                finish()
+            start = (n % slots) * size
+            view = self.shared.view[start:start + now]
+            if fill:
+                fill(offset, view)
+            request = struct.pack(">H", opcode) + struct.pack("<LLL", addr + offset, start, now)
+            busy.append((self.submit(request, check), offset, view))
+        while busy:
+            finish()
+
+    @exclusive
     def user_write_memory(self, addr, bytes):
-        self.sock.sendall(struct.pack(">H", USER_WRITE_MEMORY))
+        if self.shared and len(bytes) >= SHARED_THRESHOLD:
+            def fill(offset, slot):
+                slot[:] = bytes[offset:offset + len(slot)]
+            self.shared_transfer(USER_WRITE_MEMORY_SHARED, addr, len(bytes), fill = fill, message = "JTAG Write memory failed")
+            return
+        self.send_command(USER_WRITE_MEMORY)
         self.sock.sendall(struct.pack("<LL", addr, len(bytes)))
         self.sock.sendall(bytes)
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("JTAG Write memory failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_read_memory(self, addr, len):
         words = len >> 2
         len = words << 2
-        self.sock.sendall(struct.pack(">H", USER_READ_MEMORY))
+        if self.shared and len >= SHARED_THRESHOLD:
+            result = bytearray(len)
+            def empty(offset, slot):
+                result[offset:offset + slot.nbytes] = slot
+            self.shared_transfer(USER_READ_MEMORY_SHARED, addr, len, empty = empty, message = "JTAG Read memory failed")
+            return bytes(result)
+        self.send_command(USER_READ_MEMORY)
         self.sock.sendall(struct.pack("<LL", addr, words))
         ret = self.sock.recv(2+len, socket.MSG_WAITALL)
         if ret[0] != 0:
             raise JtagClientException("JTAG Read memory failed: " + self.errorstring(ret[0]))
         return ret[2:]
 
+    @exclusive
     def user_write_io(self, addr, bytes):
-        self.sock.sendall(struct.pack(">H", USER_WRITE_IO_REGISTERS))
+        self.send_command(USER_WRITE_IO_REGISTERS)
         self.sock.sendall(struct.pack("<LL", addr, len(bytes)))
         self.sock.sendall(bytes)
         ret = self.sock.recv(2, socket.MSG_WAITALL) # Expect 2 bytes back
         if ret[0] != 0:
             raise JtagClientException("JTAG Write I/O register failed: " + self.errorstring(ret[0]))
 
+    @exclusive
     def user_read_io(self, addr, len):
-        self.sock.sendall(struct.pack(">H", USER_READ_IO_REGISTERS))
+        self.send_command(USER_READ_IO_REGISTERS)
         self.sock.sendall(struct.pack("<LL", addr, len))
         ret = self.sock.recv(2+len, socket.MSG_WAITALL)
         if ret[0] != 0:
             raise JtagClientException("JTAG Read I/O register failed: " + self.errorstring(ret[0]))
         return ret[2:]
 
+    def queue_write_int32(self, addr, value):
+        request = struct.pack(">H", USER_WRITE_MEMORY) + struct.pack("<LLi", addr, 4, value)
+        return self.submit(request, lambda ret: self.check_reply(ret, "JTAG Write memory failed") and None)
+
+    def queue_read_int32(self, addr):
+        request = struct.pack(">H", USER_READ_MEMORY) + struct.pack("<LL", addr, 1)
+        return self.submit(request, lambda ret: struct.unpack("<i", self.check_reply(ret, "JTAG Read memory failed")[2:])[0])
+
+    def queue_write_memory(self, addr, bytes):
+        request = struct.pack(">H", USER_WRITE_MEMORY) + struct.pack("<LL", addr, len(bytes)) + bytes
+        return self.submit(request, lambda ret: self.check_reply(ret, "JTAG Write memory failed") and None)
+
+    def queue_read_memory(self, addr, len):
+        request = struct.pack(">H", USER_READ_MEMORY) + struct.pack("<LL", addr, len >> 2)
+        return self.submit(request, lambda ret: self.check_reply(ret, "JTAG Read memory failed")[2:])
+
+    def queue_write_io(self, addr, bytes):
+        request = struct.pack(">H", USER_WRITE_IO_REGISTERS) + struct.pack("<LL", addr, len(bytes)) + bytes
+        return self.submit(request, lambda ret: self.check_reply(ret, "JTAG Write I/O register failed") and None)
+
+    def queue_read_io(self, addr, len):
+        request = struct.pack(">H", USER_READ_IO_REGISTERS) + struct.pack("<LL", addr, len)
+        return self.submit(request, lambda ret: self.check_reply(ret, "JTAG Read I/O register failed")[2:])
+
+    def queue_batch(self, ops):
+        """Sends a list of (kind, addr, bytes) writes and (kind, addr, length) reads as one request.
+           The result is a list with the data of every read, in order."""
+        request = bytearray(struct.pack(">H", USER_BATCH) + struct.pack("<L", len(ops)))
+        lengths = []
+        for (kind, addr, data) in ops:
+            if isinstance(data, int):
+                request += struct.pack("<BLL", kind, addr, data)
+                lengths.append(data)
+            else:
+                request += struct.pack("<BLL", kind, addr, len(data)) + data
+        def decode(ret):
+            data = self.check_reply(ret, "JTAG Batch failed")[8:]
+            result = []
+            offset = 0
+            for length in lengths:
+                result.append(data[offset:offset + length])
+                offset += length
+            return result
+        return self.submit(bytes(request), decode)
+
+    def user_batch(self, ops):
+        return self.queue_batch(ops).result()
+
+    def user_upload_data(self, data, addr):
+        self.user_write_memory(addr, data)
+
+    def user_batch_io(self, ops):
+        """Performs a list of (addr, bytes) writes and (addr, length) reads of I/O registers in one request
+           and returns all read data concatenated."""
+        return b''.join(self.user_batch(io_batch(ops)))
+
+    @exclusive
+    def user_queue_io(self, ops):
+        """As user_batch_io, but the read data is kept until read_fifo takes it, as the FPGA fifo does for
+           a direct client. Returns the number of bytes read."""
+        data = b''.join(self.user_batch(io_batch(ops)))
+        self.fifo += data
+        return len(data)
+
+    @exclusive
+    def read_fifo(self, expected):
+        if len(self.fifo) < expected:
+            raise JtagClientException("No read data.")
+        (data, self.fifo) = (self.fifo[:expected], self.fifo[expected:])
+        return data
+
 if __name__ == '__main__':
     j = JtagClient('localhost', 4999)
     j.check_daemon()
\ No newline at end of file
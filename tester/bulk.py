@@ -0,0 +1,41 @@
+# Bulk data paths from image files to the MPSSE write buffer.
+#
+# Image files are memory mapped and handed out as memoryview slices, and MPSSE
+# commands are appended to the JTAG controller's write buffer together with
+# their payload. The file data is therefore only copied once, into the write
+# buffer that is sent over USB.
+import contextlib
+import mmap
+import os
+
+UPLOAD_CHUNK = 16384
+
+@contextlib.contextmanager
+def mapped_file(filename):
+    """Yields a read-only memoryview of the whole file."""
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b'')
+            return
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                yield view
+
+def chunks(view, size = UPLOAD_CHUNK):
+    """Yields (offset, slice) for consecutive slices of a memoryview. Each slice is released when the
+       next one is taken, such that the underlying mapping can be closed afterwards."""
+    for offset in range(0, len(view), size):
+        with view[offset:offset + size] as chunk:
+            yield (offset, chunk)
+
+def stack_data(jtag, command, *data):
+    """Appends an MPSSE command and its payload to the write buffer of the JTAG controller,
+       without first concatenating them. The payload may be any bytes-like object."""
+    ctrl = jtag._ctrl
+    length = len(command) + sum(len(d) for d in data)
+    # Same rule as JtagController._stack_cmd: flush first when the command would not fit
+    if len(ctrl._write_buff) + length + 1 >= ctrl._ftdi.fifo_sizes[0]:
+        ctrl.sync()
+    ctrl._write_buff.extend(command)
+    for d in data:
+        ctrl._write_buff.extend(d)
@@ -0,0 +1,141 @@
+# Console decoding and background capture of the console output of a JTAG client.
+#
+# Console bytes are decoded with 256-entry translation tables. Console 1 only
+# has its high bit stripped. Console 2 carries the output of the DUT as seen
+# by the tester, which may contain line noise; its control characters, other
+# than newline, carriage return and tab, are replaced by '?'. As all decoded
+# bytes are 7-bit, the text can be decoded in arbitrary pieces.
+#
+# The pump drains the console fifos (user IR 10 and 11) on a fixed cadence,
+# such that no output is lost when the fifos fill up between explicit reads.
+# Complete lines are kept with a time stamp in a bounded ring and are passed
+# to the subscribers. Text that has not been taken yet by user_read_console
+# is kept separately, such that the client's own console reads keep working
+# while the pump runs.
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger('Console')
+logger.setLevel(logging.DEBUG)
+
+CONSOLE_FIFOS = { 1: 10, 2: 11 } # user IR of each console fifo
+KEEP_CONTROLS = b'\n\r\t'
+
+PUMP_INTERVAL = 0.05 # seconds between drains of the fifos
+RING_LINES = 5000 # lines kept for the board log
+UNREAD_LIMIT = 65536 # characters kept per console until they are taken
+
+def make_table(filter_controls):
+    table = bytearray(i & 0x7F for i in range(256))
+    if filter_controls:
+        for i in range(256):
+            if table[i] < 0x20 and table[i] not in KEEP_CONTROLS:
+                table[i] = ord('?')
+    return bytes(table)
+
+TABLES = { 1: make_table(False), 2: make_table(True) }
+
+def decode_console(raw, console = 1):
+    """Decodes bytes read from a console fifo to text."""
+    return bytes(raw).translate(TABLES[console]).decode('ascii')
+
+class ConsoleDecoder:
+    """Decodes a console byte stream that arrives in pieces, and splits it into complete lines."""
+    def __init__(self, console = 1):
+        self.table = TABLES[console]
+        self.partial = ''
+
+    def feed(self, raw):
+        """Returns (text, complete lines) for the next piece of the stream."""
+        text = bytes(raw).translate(self.table).decode('ascii')
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
+        return (text, [ line.rstrip('\r') for line in lines ])
+
+class ConsoleLine:
+    def __init__(self, timestamp, console, text):
+        self.timestamp = timestamp
+        self.console = console
+        self.text = text
+
+    def __str__(self):
+        return f"{time.strftime('%H:%M:%S', time.localtime(self.timestamp))}.{int(self.timestamp * 1000) % 1000:03d} [{self.console}] {self.text}"
+
+class ConsolePump:
+    def __init__(self, client, name, consoles = (1,), interval = PUMP_INTERVAL, capacity = RING_LINES):
+        self.client = client
+        self.name = name
+        self.consoles = consoles
+        self.interval = interval
+        self.lines = collections.deque(maxlen = capacity)
+        self.decoders = { c: ConsoleDecoder(c) for c in consoles }
+        self.unread = { c: '' for c in consoles }
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target = self.run, name = f"Console {self.name}", daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logger.warning(f"{self.name}: console capture failed: {e}")
+            self.stopping.wait(self.interval)
+
+    def drain(self):
+        for console in self.consoles:
+            raw = self.client.read_console_fifo(console)
+            if raw:
+                self.add_raw(console, raw, time.time())
+
+    def add_raw(self, console, raw, timestamp):
+        with self.lock:
+            (text, lines) = self.decoders[console].feed(raw)
+            self.unread[console] = (self.unread[console] + text)[-UNREAD_LIMIT:]
+            new = [ ConsoleLine(timestamp, console, line) for line in lines ]
+            self.lines.extend(new)
+            subscribers = list(self.subscribers)
+        for line in new:
+            for callback in subscribers:
+                callback(self.name, line)
+
+    def take(self, console):
+        """Returns the text of the console that arrived since the previous call."""
+        with self.lock:
+            text = self.unread[console]
+            self.unread[console] = ''
+        return text
+
+    def subscribe(self, callback):
+        """Calls callback(name, line) from the pump thread for every new line."""
+        with self.lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers.remove(callback)
+
+    def history(self, since = 0):
+        """Returns all lines in the ring with a time stamp not before 'since', including unfinished lines."""
+        with self.lock:
+            lines = [ line for line in self.lines if line.timestamp >= since ]
+            now = time.time()
+            lines += [ ConsoleLine(now, c, d.partial) for (c, d) in self.decoders.items() if d.partial ]
+        return lines
+
+    def dump(self, since = 0):
+        return '\n'.join(f"{self.name} {line}" for line in self.history(since))
@@ -0,0 +1,132 @@
+# Registry of running JTAG daemons.
+#
+# Every daemon records, for each FTDI channel it serves, the address it
+# listens on and its process ID, in one small JSON file in the temporary
+# directory. Clients look up the channel they need and connect to it
+# directly. Entries of processes that no longer exist are ignored, and
+# dropped the next time the file is written. Daemons update the file under
+# an exclusive lock on a separate lock file, so that daemons starting at the
+# same time keep each other's entries.
+import contextlib
+import json
+import os
+import tempfile
+import logging
+if os.name == 'nt':
+    import ctypes
+    import msvcrt
+else:
+    import fcntl
+
+# create logger
+logger = logging.getLogger('Daemons')
+logger.setLevel(logging.INFO)
+
+REGISTRY = os.path.join(tempfile.gettempdir(), 'jtag_daemons.json')
+
+def channel_key(url):
+    """Returns 'serial/interface' of an FTDI url such as ftdi://ftdi:2232h:FT1234/1; the serial is empty when the url has none."""
+    (device, _, interface) = url.partition('://')[2].rpartition('/')
+    fields = device.split(':')
+    serial = fields[2] if len(fields) > 2 else ''
+    return f"{serial}/{interface}"
+
+if os.name == 'nt':
+    PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+    STILL_ACTIVE = 259
+    ERROR_ACCESS_DENIED = 5
+
+    def alive(pid):
+        # os.kill would terminate the process on Windows
+        kernel32 = ctypes.WinDLL('kernel32', use_last_error = True)
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return ctypes.get_last_error() == ERROR_ACCESS_DENIED
+        try:
+            code = ctypes.c_ulong()
+            return not kernel32.GetExitCodeProcess(handle, ctypes.byref(code)) or code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+else:
+    def alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+def load(filename = REGISTRY):
+    try:
+        with open(filename, "r") as fi:
+            entries = json.load(fi)
+    except (OSError, ValueError):
+        return { }
+    return { key: entry for (key, entry) in entries.items() if alive(entry['pid']) }
+
+def save(entries, filename = REGISTRY):
+    # Replace the file as a whole, such that a client never reads half of it
+    temp = f"{filename}.{os.getpid()}"
+    with open(temp, "w") as fo:
+        json.dump(entries, fo, indent = 1)
+    os.replace(temp, filename)
+
+if os.name == 'nt':
+    def lock_file(f):
+        # msvcrt locks a byte range from the current position; LK_LOCK gives up after 10 seconds
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                pass
+
+    def unlock_file(f):
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+else:
+    def lock_file(f):
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+    def unlock_file(f):
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+@contextlib.contextmanager
+def locked(filename = REGISTRY):
+    with open(f"{filename}.lock", "a+") as lock:
+        lock_file(lock)
+        try:
+            yield
+        finally:
+            unlock_file(lock)
+
+def register(url, address, filename = REGISTRY):
+    with locked(filename):
+        entries = load(filename)
+        entries[channel_key(url)] = { 'host': address[0], 'port': address[1], 'pid': os.getpid(), 'url': url }
+        save(entries, filename)
+
+def unregister(url, filename = REGISTRY):
+    with locked(filename):
+        entries = load(filename)
+        entry = entries.get(channel_key(url))
+        if entry and entry['pid'] == os.getpid():
+            del entries[channel_key(url)]
+            save(entries, filename)
+
+def find_daemon(interface, serial = None, filename = REGISTRY):
+    """Returns (host, port) of the daemon serving the given interface (1 = A, 2 = B) of an FTDI device.
+       Without a serial, a daemon serving the interface of any device is taken, as long as there is only one."""
+    entries = load(filename)
+    if serial is not None:
+        entry = entries.get(f"{serial}/{interface}")
+    else:
+        matches = [ e for (key, e) in entries.items() if key.endswith(f"/{interface}") ]
+        if len(matches) > 1:
+            logger.warning(f"Several daemons serve interface {interface}; taking {matches[0]['url']}")
+        entry = matches[0] if matches else None
+    if not entry:
+        return None
+    return (entry['host'], entry['port'])
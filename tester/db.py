@@ -1,13 +1,181 @@
 import boto3 as aws
+from botocore.exceptions import ClientError
 import os
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import logging
+from decimal import Decimal
+
+# create logger
+logger = logging.getLogger('Database')
+logger.setLevel(logging.INFO)
+
+JOURNAL_FILE = '~/.config/u2pl_db_journal.sqlite'
+UPLOAD_BATCH = 25 # items per upload round; one DynamoDB batch write
+RETRY_START = 2.0 # seconds after the first failed upload
+RETRY_MAX = 300.0
+# DynamoDB errors that no retry will cure: the item itself is refused, e.g. larger than 400 KB
+PERMANENT_ERRORS = { 'ValidationException', 'SerializationException' }
+
+def permanent(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in PERMANENT_ERRORS
+
+def encode_decimal(value):
+    # DynamoDB wants Decimal for numbers with a fraction; JSON would turn them into floats
+    if isinstance(value, Decimal):
+        return { '$decimal': str(value) }
+    raise TypeError(f"Can't store {type(value).__name__} in the journal")
+
+def encode_item(item):
+    return json.dumps(item, default = encode_decimal)
+
+def decode_item(text):
+    return json.loads(text, object_hook = lambda d: Decimal(d['$decimal']) if '$decimal' in d else d)
+
+class WriteBehind:
+    """Journals items for DynamoDB tables in a local SQLite file and uploads them in the background.
+       An item is removed from the journal only after its upload succeeded, so items survive being
+       offline and restarts; uploads are retried with increasing delay. put_item replaces the item
+       with the same key, so uploading an item twice (after a crash between upload and removal) is harmless.
+       Items that DynamoDB refuses are moved to the 'failed' table of the journal, with the error, such that
+       they do not hold up the items after them."""
+    def __init__(self, db, filename = JOURNAL_FILE):
+        self.db = db
+        self.conn = sqlite3.connect(os.path.expanduser(filename), check_same_thread = False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                          "id TEXT UNIQUE, tbl TEXT, item TEXT, created REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS failed (seq INTEGER PRIMARY KEY, "
+                          "id TEXT, tbl TEXT, item TEXT, created REAL, error TEXT, failed REAL)")
+        self.conn.commit()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event() # new items
+        self.retry = threading.Event() # ends a wait after a failed upload; new items don't
+        self.idle = threading.Condition(self.lock)
+        self.stopped = False
+        self.failures = 0
+        self.thread = threading.Thread(target = self.run, name = 'Database', daemon = True)
+        self.thread.start()
+
+    def put(self, table, item):
+        data = encode_item(item)
+        with self.lock:
+            self.conn.execute("INSERT INTO journal (id, tbl, item, created) VALUES (?, ?, ?, ?)",
+                              (str(uuid.uuid4()), table, data, time.time()))
+            self.conn.commit()
+        self.wakeup.set()
+
+    def pending(self, table = None):
+        """Returns the items not uploaded yet, oldest first."""
+        with self.lock:
+            rows = self.conn.execute("SELECT tbl, item FROM journal ORDER BY seq").fetchall()
+        return [ decode_item(item) for (tbl, item) in rows if table is None or tbl == table ]
+
+    def next_batch(self):
+        with self.lock:
+            return self.conn.execute("SELECT seq, tbl, item FROM journal ORDER BY seq LIMIT ?", (UPLOAD_BATCH,)).fetchall()
+
+    def failed(self):
+        """Returns (table, item, error) of the items that DynamoDB refused, oldest first."""
+        with self.lock:
+            rows = self.conn.execute("SELECT tbl, item, error FROM failed ORDER BY seq").fetchall()
+        return [ (tbl, decode_item(item), error) for (tbl, item, error) in rows ]
+
+    def remove(self, rows):
+        with self.lock:
+            self.conn.executemany("DELETE FROM journal WHERE seq = ?", [ (row[0],) for row in rows ])
+            self.conn.commit()
+
+    def reject(self, row, error):
+        (seq, tbl, item) = row
+        logger.error(f"{tbl} refused item {seq}, moved to the failed items of the journal: {error}")
+        with self.lock:
+            self.conn.execute("INSERT INTO failed (seq, id, tbl, item, created, error, failed) "
+                              "SELECT seq, id, tbl, item, created, ?, ? FROM journal WHERE seq = ?", (str(error), time.time(), seq))
+            self.conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self.conn.commit()
+
+    def write_batch(self, tbl, rows):
+        table = self.db.table(tbl)
+        # A batch may not hold the same key twice; the last write of a key wins, as it would have one by one
+        keys = [ k['AttributeName'] for k in table.key_schema ]
+        with table.batch_writer(overwrite_by_pkeys = keys) as batch:
+            for (_, _, item) in rows:
+                batch.put_item(Item = decode_item(item))
+
+    def upload(self, rows):
+        tables = { }
+        for row in rows:
+            tables.setdefault(row[1], []).append(row)
+        for (tbl, group) in tables.items():
+            try:
+                self.write_batch(tbl, group)
+                self.remove(group)
+                continue
+            except ClientError as e:
+                if not permanent(e):
+                    raise
+            # One refused item fails the whole batch; find it by writing the items one by one
+            for row in group:
+                try:
+                    self.db.table(tbl).put_item(Item = decode_item(row[2]))
+                except ClientError as e:
+                    if not permanent(e):
+                        raise
+                    self.reject(row, e)
+                    continue
+                self.remove([ row ])
+
+    def run(self):
+        while not self.stopped:
+            rows = self.next_batch()
+            if not rows:
+                with self.idle:
+                    self.idle.notify_all()
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            try:
+                self.upload(rows)
+                self.failures = 0
+            except Exception as e:
+                self.failures += 1
+                delay = min(RETRY_MAX, RETRY_START * 2 ** (self.failures - 1))
+                logger.warning(f"Upload of {len(rows)} items failed ({e}); {len(self.pending())} items kept, retry in {delay:.0f} s")
+                self.retry.wait(delay)
+                self.retry.clear()
+
+    def flush(self, timeout = 10.0):
+        """Waits until the journal is empty; returns False when items are still waiting after the timeout."""
+        self.wakeup.set()
+        self.retry.set()
+        deadline = time.monotonic() + timeout
+        with self.idle:
+            while self.conn.execute("SELECT COUNT(*) FROM journal").fetchone()[0]:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.idle.wait(remaining):
+                    return False
+        return True
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.retry.set()
+        self.thread.join()
+        self.conn.close()
 
 class Database:
-    def __init__(self):
+    def __init__(self, journal = None):
+        """With a journal file, add_board, add_test_results and add_log return right away and the items
+           are uploaded in the background."""
         with open(os.path.expanduser("~/.config/aws_credentials"), "r") as cred:
             lines = [line for line in cred]
             self.ACCESS_KEY = lines[0].strip()
             self.SECRET_KEY = lines[1].strip()
         self.open_tables()
+        self.writer = WriteBehind(self, journal) if journal else None
 
     def open_tables(self):
         dynamodb = aws.resource('dynamodb', region_name = 'us-east-1', aws_access_key_id = self.ACCESS_KEY, aws_secret_access_key = self.SECRET_KEY)
@@ -16,6 +184,15 @@ class Database:
         self.u2pl_tests = dynamodb.Table('u2pl_tests')
         self.u2pl_logs = dynamodb.Table('u2pl_logs')
 
+    def table(self, name):
+        return { 'test': self.test, 'u2pl_boards': self.u2pl_boards, 'u2pl_tests': self.u2pl_tests, 'u2pl_logs': self.u2pl_logs }[name]
+
+    def put(self, name, dct):
+        if self.writer:
+            self.writer.put(name, dct)
+        else:
+            self.table(name).put_item(Item = dct)
+
     def dump_sandbox(self):
         for item in self.test.scan()['Items']:
             print(item)
@@ -28,19 +205,32 @@ class Database:
         for item in self.u2pl_tests.scan()['Items']:
             print(item)
 
+    def scan_test_results(self):
+        response = self.u2pl_tests.scan()
+        items = response['Items']
+        while 'LastEvaluatedKey' in response:
+            response = self.u2pl_tests.scan(ExclusiveStartKey = response['LastEvaluatedKey'])
+            items += response['Items']
+        return items
+
     def get_board(self, serial):
+        # A board that was written while offline is not in the table yet
+        if self.writer:
+            boards = [ board for board in self.writer.pending('u2pl_boards') if board.get('serial') == serial ]
+            if boards:
+                return boards[-1]
         response = self.u2pl_boards.get_item(Key = { 'serial' : serial })
         if 'Item' in response:
             return response['Item']
 
     def add_board(self, dct):
-        response = self.u2pl_boards.put_item(Item = dct)
+        self.put('u2pl_boards', dct)
 
     def add_test_results(self, dct):
-        response = self.u2pl_tests.put_item(Item = dct)
+        self.put('u2pl_tests', dct)
 
     def add_log(self, dct):
-        response = self.u2pl_logs.put_item(Item = dct)
+        self.put('u2pl_logs', dct)
 
 if __name__ == '__main__':
     db = Database()
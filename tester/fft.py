@@ -2,7 +2,10 @@
 # Python example - Fourier transform using numpy.fft method
 import numpy as np
 import matplotlib.pyplot as plotter
+from matplotlib.figure import Figure
 from io import  BytesIO
+import threading
+from tone import capture_channels
 
 def do_fft(amplitude, samplingFrequency):
     # Frequency domain representation
@@ -39,7 +42,7 @@ def plot_all(left, right, samplingFrequency, fftleft, fftright):
     frequencies = values/timePeriod
 
     # Create subplot
-    figure, axis = plotter.subplots(4 if right else 2, 1)
+    figure, axis = plotter.subplots(4 if right is not None else 2, 1)
     plotter.subplots_adjust(hspace=1)
 
     # Time domain representation for sine wave 1
@@ -54,7 +57,7 @@ def plot_all(left, right, samplingFrequency, fftleft, fftright):
     axis[1].set_xlabel('Frequency')
     axis[1].set_ylabel('Amplitude')
 
-    if right:
+    if right is not None:
         # Time domain representation for sine wave 2
         axis[2].set_title('Right Wave')
         axis[2].plot(time, right)
@@ -70,34 +73,53 @@ def plot_all(left, right, samplingFrequency, fftleft, fftright):
 
     plotter.show()
 
-def calc_fft(filename, plot = False):
-    # Create arrays from file
-    filedata = np.fromfile(filename, [('left', np.int32), ('right', np.int32)])
-    left, right = zip(*filedata)
-    left = np.array(left) / pow(2.0, 31)
-    right = np.array(right) / pow(2.0, 31)
-
+def save_plot(filename, waves, samplingFrequency = 48000):
+    # Renders to a PNG file without pyplot, so it needs no display and does not block on a window
+    figure = Figure(figsize = (10, 4 * len(waves)))
+    figure.subplots_adjust(hspace = 0.5)
+    axis = figure.subplots(2 * len(waves), 1, squeeze = False)[:, 0]
+    time = np.arange(len(waves[0])) / samplingFrequency
+    frequencies = np.fft.rfftfreq(len(waves[0]), 1 / samplingFrequency)
+    for i, wave in enumerate(waves):
+        axis[2*i].set_title(f'Wave {i}')
+        axis[2*i].plot(time, wave)
+        axis[2*i].set_xlabel('Time')
+        axis[2*i].set_ylabel('Amplitude')
+
+        axis[2*i+1].set_title(f'Fourier transform {i}')
+        axis[2*i+1].set_yscale("log")
+        axis[2*i+1].plot(frequencies, np.abs(np.fft.rfft(wave)) / len(wave))
+        axis[2*i+1].set_xlabel('Frequency')
+        axis[2*i+1].set_ylabel('Amplitude')
+    figure.savefig(filename)
+
+def save_plot_background(filename, waves, samplingFrequency = 48000):
+    """Writes the diagnostic plot on a separate thread, such that the test run can continue."""
+    thread = threading.Thread(target = save_plot, args = (filename, waves, samplingFrequency))
+    thread.start()
+    return thread
+
+def analyze_capture(data, channels = 2, plot = False):
+    """Analyzes captured audio as returned by user_read_memory; returns (amplitude, frequency) per channel."""
     # How many time points are needed i,e., Sampling Frequency
     samplingFrequency   = 48000
-    left_ampl, left_freq, fft_left = do_fft(left, samplingFrequency)    
-    right_ampl, right_freq, fft_right = do_fft(right, samplingFrequency)    
+    waves = capture_channels(data, channels)
+    results = [ do_fft(wave, samplingFrequency) for wave in waves ]
 
     if plot:
-        plot_all(left, right, samplingFrequency, fft_left, fft_right)
-
-    return ((left_ampl, left_freq), (right_ampl, right_freq))
-
-def calc_fft_mono(filename, plot = False):
-    # Create arrays from file
-    filedata = np.fromfile(filename, [('spk', np.int32)])
-    (spk,) = zip(*filedata)
-    spk = np.array(spk) / pow(2.0, 31)
+        if channels == 1:
+            plot_all(waves[0], None, samplingFrequency, results[0][2], results[0][2])
+        else:
+            plot_all(waves[0], waves[1], samplingFrequency, results[0][2], results[1][2])
 
-    # How many time points are needed i,e., Sampling Frequency
-    samplingFrequency   = 48000
-    ampl, freq, fft = do_fft(spk, samplingFrequency)    
+    return [ (ampl, freq) for (ampl, freq, _fft) in results ]
 
-    if plot:
-        plot_all(spk, None, samplingFrequency, fft, fft)
+def calc_fft(filename, plot = False):
+    with open(filename, 'rb') as fi:
+        (left, right) = analyze_capture(fi.read(), 2, plot)
+    return (left, right)
 
-    return (ampl, freq)
+def calc_fft_mono(filename, plot = False):
+    with open(filename, 'rb') as fi:
+        (spk,) = analyze_capture(fi.read(), 1, plot)
+    return spk
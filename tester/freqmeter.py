@@ -0,0 +1,107 @@
+# Frequency counter readout of the test FPGA.
+#
+# Each counter block consists of four 32-bit registers. A register with bit 24
+# set holds a valid gated count in its lower 24 bits, in units of 1/65536 MHz.
+# Both blocks are read in one batched transaction; the reads are repeated with
+# a short, growing, interval until both blocks hold a valid count. When more
+# than one reading is requested, the gated counts are averaged into a ppm
+# estimate with a 95% confidence bound. A further reading only counts once the
+# counter registers have changed, or once two gate times have passed, so that
+# the same gated count is never taken twice.
+import math
+import struct
+import time
+
+REFCLK_COUNTER = 0x100400
+OSC_COUNTER = 0x100500
+COUNTER_BLOCK = 16
+VALID = 0x1000000
+COUNT_MASK = 0xFFFFFF
+COUNT_SCALE = 65536 # counts per MHz
+GATE_TIME = COUNT_SCALE / 1e6 # seconds, time to gate a new count
+
+POLL_START = 0.005
+POLL_MAX = 0.1
+
+# Two sided 95% Student t values, by degrees of freedom
+T95 = { 1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31, 9: 2.26 }
+
+class FrequencyTimeout(Exception):
+    pass
+
+class FrequencyResult:
+    def __init__(self, counts, nominal):
+        self.counts = counts
+        self.nominal = nominal
+        self.freq = sum(counts) / (len(counts) * COUNT_SCALE) # MHz
+        self.ppm = None
+        self.bound = None
+        if nominal:
+            self.ppm = 1e6 * ((self.freq / nominal) - 1.)
+            self.bound = confidence_ppm(counts, nominal)
+
+    def __str__(self):
+        if self.ppm is None:
+            return f"{self.freq:.6f} MHz ({len(self.counts)} readings)"
+        return f"{self.freq:.6f} MHz, {self.ppm:.1f} +/- {self.bound:.1f} ppm ({len(self.counts)} readings)"
+
+def confidence_ppm(counts, nominal):
+    """95% confidence bound of the mean in ppm, including the quantization of the counter."""
+    lsb = 1e6 / (nominal * COUNT_SCALE)
+    quantization = lsb / math.sqrt(12)
+    n = len(counts)
+    if n < 2:
+        return math.sqrt(quantization ** 2 + (lsb / 2) ** 2)
+    mean = sum(counts) / n
+    sdev = math.sqrt(sum((c - mean) ** 2 for c in counts) / (n - 1)) * lsb
+    spread = T95.get(n - 1, 1.96) * sdev / math.sqrt(n)
+    return math.sqrt(spread ** 2 + quantization ** 2 / n)
+
+def valid_count(block):
+    """Returns the count from the first valid register in the block, or None."""
+    for value in struct.unpack("<LLLL", block):
+        if value & VALID:
+            return value & COUNT_MASK
+    return None
+
+def read_counters(jtag, timeout = 2.0, previous = None):
+    """Reads both counter blocks until each holds a valid count. Returns (refclk count, oscillator count)
+       and a reading to pass as 'previous' to the next call, which then waits for a new gated count."""
+    ops = [ (REFCLK_COUNTER, COUNTER_BLOCK), (OSC_COUNTER, COUNTER_BLOCK) ]
+    deadline = time.perf_counter() + timeout
+    interval = POLL_START
+    blocks = [ None, None ]
+    counts = [ None, None ]
+    while True:
+        data = jtag.user_batch_io(ops)
+        now = time.perf_counter()
+        for i in range(2):
+            block = data[i * COUNTER_BLOCK:(i + 1) * COUNTER_BLOCK]
+            if counts[i] is not None:
+                continue
+            # A block that did not change still holds the count of the previous reading, unless that is
+            # so long ago that the new gate simply gave the same count
+            if previous and block == previous[0][i] and now - previous[1] < 2 * GATE_TIME:
+                continue
+            counts[i] = valid_count(block)
+            blocks[i] = block
+        (ref, osc) = counts
+        if ref is not None and osc is not None:
+            return ((ref, osc), (blocks, now))
+        if now + interval > deadline:
+            raise FrequencyTimeout("No valid frequency count" if ref is None and osc is None else
+                                   ("No valid reference clock count" if ref is None else "No valid oscillator count"))
+        time.sleep(interval)
+        interval = min(interval * 2, POLL_MAX)
+
+def measure_frequencies(jtag, ref_nominal, osc_nominal = None, readings = 1, timeout = 2.0):
+    """Returns a FrequencyResult for the reference clock and for the oscillator, averaged over
+       'readings' different gated counts."""
+    refs = []
+    oscs = []
+    previous = None
+    for i in range(readings):
+        ((ref, osc), previous) = read_counters(jtag, timeout, previous)
+        refs.append(ref)
+        oscs.append(osc)
+    return (FrequencyResult(refs, ref_nominal), FrequencyResult(oscs, osc_nominal))
@@ -2,6 +2,7 @@
 
 import tkinter as tk
 import logging
+import time
 import git
 from tkinter import ttk, messagebox
 import tkinter.scrolledtext as tkscrolled
@@ -10,7 +11,8 @@ from pprint import pprint
 from tests import UltimateIIPlusLatticeTests, TestFail, TestFailCritical, JtagClientException
 from support import TesterADC
 from datetime import datetime
-from db import Database
+from db import Database, JOURNAL_FILE
+from ordering import TestStatistics, order_tests
 from decimal import *
 
 # sudo apt install python3-pil python3-pil.imagetk
@@ -71,7 +73,12 @@ class InfoFields:
 class MyGui:
     def __init__(self):
         self.CollectTests()
-        self.db = Database()
+        self.db = Database(journal = JOURNAL_FILE)
+        self.history = TestStatistics()
+        try:
+            self.history.seed_from_db(self.db, [ name for name in self.functions if "test" in name ])
+        except Exception as e:
+            logging.getLogger('Ordering').warning(f"Could not read test history from database: {e}")
         repo = git.Repo(search_parent_directories=True)
         self.gitsha = repo.head.object.hexsha
 
@@ -113,8 +120,11 @@ class MyGui:
         self.textbox.see(tk.END)
         self.window.update()
         critical = False
+        failed = True
+        start_time = time.perf_counter()
         try:
             func(self.testsuite)
+            failed = False
             self.test_icon_canvases[name].itemconfig(self.test_icon_images[name], image = self.img_pass)
             self.textbox.insert(tk.END, "-> Result: OK!\n\n")
         except TestFailCritical as e:
@@ -133,6 +143,7 @@ class MyGui:
         except JtagClientException as e:
             messagebox.showerror("Failure!", f"Communication Error!\n{e}\nRestart Tester Application!")
             exit()
+        self.history.record(name, time.perf_counter() - start_time, failed)
 
         if name in self.after:
             try:
@@ -186,11 +197,13 @@ class MyGui:
         self.serial_entry.delete(0, tk.END)
         self.window.update()
 
-        for name in self.functions:
-            if "test" in name:
-                if True: #not self.test_skip[name].get():
-                    if self.RunOneTest(name): # Returns 'true' when a critical error occurred (could also have re-raised)
-                        break
+        # Cheap tests that are likely to fail run first, as far as the dependencies allow
+        tests = [ name for name in self.functions if "test" in name ]
+        for test in order_tests(tests, self.testsuite.dependencies, self.history):
+            if True: #not self.test_skip[test].get():
+                if self.RunOneTest(test): # Returns 'true' when a critical error occurred (could also have re-raised)
+                    break
+        self.history.save()
 
         # If all tests are successful, the board can be flashed
         if self.errors == 0:
@@ -200,8 +213,13 @@ class MyGui:
             else:
                 self.testsuite.program_tester(self.FlashUpdateFPGA)
                 self.flashed = "SlotTester"
+            self.RunOneTest('late_098_verify_flash')
 
-            if not self.flash_tester.get():
+            if self.errors:
+                self.flashed = "Verify failed"
+                self.textbox.insert(tk.END, "\n!!! FLASH CONTENTS DO NOT MATCH THE IMAGES !!!\n\n")
+                messagebox.showerror("Reject", "Flash verification failed after Flashing.")
+            elif not self.flash_tester.get():
                 self.boot_ok = self.testsuite.late_099_boot()
                 self.testsuite.dut_off()            
                 if not self.boot_ok:
@@ -392,7 +410,7 @@ class MyGui:
 
         self.db.add_log({'serial' : self.serial,
                          'date': time,
-                         'log': self.textbox.get("1.0", tk.END) })
+                         'log': self.textbox.get("1.0", tk.END) + "\nConsole output:\n" + self.testsuite.console_log() })
 
 if __name__ == '__main__':
     gui = MyGui()
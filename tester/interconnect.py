@@ -0,0 +1,102 @@
+# Pattern generation and fault decoding for interconnect (pin to pin) tests.
+#
+# Instead of a walking one and a walking zero per pin (2 x N patterns), every
+# pin gets a unique code of W = ceil(log2(N+2)) bits, excluding all zeros and
+# all ones, such that every pin is driven both high and low. Pattern t drives
+# bit t of each pin's code. The same W patterns are then repeated inverted
+# (true / complement counting sequence), such that a short between two pins
+# shows up both as wired-AND and as wired-OR. A stuck pin is seen as a code
+# of all zeros or all ones, shorted pins share the same wrong code and pins
+# that follow another pin return that pin's code.
+#
+# Patterns and responses are handled as 6 byte words (48 pins), little endian,
+# as they are written to and read from the PIO registers at 0x100300. The
+# comparison is done on all patterns and pins at once, with NumPy bit arrays.
+import numpy as np
+
+PIO_BYTES = 6
+
+def code_width(count):
+    return max(1, (count + 1).bit_length())
+
+def bits_to_mask(test_bits):
+    mask = 0
+    for i in test_bits:
+        mask |= 1 << i
+    return mask
+
+def pin_codes(test_bits):
+    """Returns a map of pin to its unique code."""
+    return { pin: idx + 1 for idx, pin in enumerate(test_bits) }
+
+def counting_patterns(test_bits):
+    """Returns the list of patterns, one integer per pattern, with bit n driving pin n."""
+    codes = pin_codes(test_bits)
+    width = code_width(len(test_bits))
+    mask = bits_to_mask(test_bits)
+    patterns = []
+    for t in range(width):
+        pattern = 0
+        for pin, code in codes.items():
+            if code & (1 << t):
+                pattern |= 1 << pin
+        patterns.append(pattern)
+    patterns += [ p ^ mask for p in patterns ]
+    return patterns
+
+def pattern_bytes(pattern, extra = 0):
+    return (pattern | extra).to_bytes(PIO_BYTES, 'little')
+
+def unpack_words(words, test_bits):
+    """Converts concatenated 6 byte words (or a list of integers) to a (patterns x pins) boolean array of the test bits."""
+    if not isinstance(words, (bytes, bytearray)):
+        words = b''.join(pattern_bytes(w) for w in words)
+    raw = np.frombuffer(words, dtype = np.uint8).reshape(-1, PIO_BYTES)
+    bits = np.unpackbits(raw, axis = 1, bitorder = 'little')
+    return bits[:, list(test_bits)].astype(bool)
+
+def fault_matrix(driven, received):
+    """Compares driven and received bit arrays (patterns x pins) and returns
+    (errors, stuck0, stuck1, follows, candidates). 'errors', 'stuck0' and
+    'stuck1' are per received pin. 'follows[i, j]' is set when received pin j
+    returned exactly what was driven on pin i. 'candidates[i, j]' is set when
+    all errors on pin j occur in patterns where pin i was driven differently
+    from pin j, i.e. when a short between i and j explains all errors on j."""
+    error_bits = driven ^ received
+    errors = error_bits.any(axis = 0)
+    stuck0 = ~received.any(axis = 0)
+    stuck1 = received.all(axis = 0)
+    follows = (driven[:, :, None] == received[:, None, :]).all(axis = 0)
+    differs = driven[:, :, None] ^ driven[:, None, :]
+    unexplained = (error_bits[:, None, :] & ~differs).any(axis = 0)
+    candidates = errors[None, :] & ~unexplained
+    return (errors, stuck0, stuck1, follows, candidates)
+
+def decode_responses(test_bits, patterns, responses, names):
+    """Compares the responses to the patterns and returns a list of (pin, description) for all failing pins."""
+    driven = unpack_words(patterns, test_bits)
+    received = unpack_words(responses, test_bits)
+    (errors, stuck0, stuck1, follows, candidates) = fault_matrix(driven, received)
+    if not errors.any():
+        return []
+
+    # Shorted pins return identical, wrong, responses
+    same = (received[:, :, None] == received[:, None, :]).all(axis = 0) & errors[:, None] & errors[None, :]
+    np.fill_diagonal(same, False)
+
+    faults = []
+    for j in np.flatnonzero(errors):
+        pin = test_bits[j]
+        if stuck0[j]:
+            faults.append((pin, f"{names[pin]} is stuck at 0"))
+        elif stuck1[j]:
+            faults.append((pin, f"{names[pin]} is stuck at 1"))
+        elif same[j].any():
+            faults.append((pin, f"{names[pin]} is shorted to {', '.join(names[test_bits[i]] for i in np.flatnonzero(same[j]))}"))
+        elif follows[:, j].any():
+            faults.append((pin, f"{names[pin]} follows {names[test_bits[np.flatnonzero(follows[:, j])[0]]]}"))
+        elif candidates[:, j].any():
+            faults.append((pin, f"{names[pin]} is possibly shorted to {', '.join(names[test_bits[i]] for i in np.flatnonzero(candidates[:, j]))}"))
+        else:
+            faults.append((pin, f"{names[pin]} is shorted to an untested signal"))
+    return faults
@@ -0,0 +1,36 @@
+# Command streams for I/O register access over user JTAG (user IR 5).
+#
+# The address is sent as three bytes, each followed by the opcode that
+# latches it (4, 5, 6). Every data byte is followed by opcode 0x0F, which
+# writes it to the current address; every read is a dummy byte followed by
+# opcode 0x0D, which reads the current address into the fifo. Commands are
+# built in a preallocated bytearray; the data bytes and the opcodes are
+# filled in with one slice assignment each.
+import functools
+
+IO_HEADER = 6
+IO_WRITE = 0x0F
+IO_READ = 0x0D
+
+@functools.lru_cache(maxsize = 256)
+def io_header(addr):
+    return bytes((addr & 0xFF, 4, (addr >> 8) & 0xFF, 5, (addr >> 16) & 0xFF, 6))
+
+@functools.lru_cache(maxsize = 64)
+def io_read_command(addr, length):
+    """Returns the command to read 'length' bytes from an I/O address."""
+    command = bytearray(IO_HEADER + 2 * length)
+    command[:IO_HEADER] = io_header(addr)
+    command[IO_HEADER + 1::2] = bytes((IO_READ,)) * length
+    return bytes(command)
+
+def io_write_command(addr, data, command = None):
+    """Returns the command to write 'data' to an I/O address; appended to 'command' when given."""
+    if command is None:
+        command = bytearray()
+    start = len(command)
+    command.extend(bytes(IO_HEADER + 2 * len(data)))
+    command[start:start + IO_HEADER] = io_header(addr)
+    command[start + IO_HEADER::2] = data
+    command[start + IO_HEADER + 1::2] = bytes((IO_WRITE,)) * len(data)
+    return command
@@ -0,0 +1,86 @@
+# What the JTAG clients have in common, whether they reach the FPGA directly
+# over USB (jtag_direct) or through the JTAG daemon (_jtag_functions).
+#
+# ClientHelpers builds the console capture, the console wait and the register
+# map on the requests of the client itself. A client provides
+# read_console_fifo(console), user_read_memory, user_read_io and
+# user_queue_io, and sets self.lock, self.pump and self.registers.
+import functools
+import logging
+import time
+from console import ConsolePump, decode_console
+from regmap import RegisterMap
+
+logger = logging.getLogger('JTAG')
+
+CONSOLE_POLL = 0.02 # Seconds between console reads while waiting for output
+
+class JtagClientException(Exception):
+    pass
+
+def exclusive(func):
+    # Holds the client's lock during the whole JTAG transaction, such that the console pump cannot interleave with it
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+class ClientHelpers:
+    def user_read_console(self, do_print = False):
+        # When the console pump runs, it owns the fifo; the text is taken from its buffer
+        text = self.pump.take(1) if self.pumps(1) else decode_console(self.read_console_fifo(1), 1)
+        if do_print:
+            logger.info(text)
+        return text
+
+    def user_read_console2(self, do_print = False):
+        text = self.pump.take(2) if self.pumps(2) else decode_console(self.read_console_fifo(2), 2)
+        if do_print:
+            logger.info(text)
+        return text
+
+    def pumps(self, console):
+        return self.pump is not None and console in self.pump.consoles
+
+    def start_console_pump(self, name, consoles = (1,), interval = 0.05):
+        """Starts capturing the given consoles in the background. Returns the pump, to subscribe to or to dump."""
+        if not self.pump:
+            self.pump = ConsolePump(self, name, consoles, interval)
+            self.pump.start()
+        return self.pump
+
+    def register_map(self, host_owned = ()):
+        """Returns the write-combining register map of this client; created on first use with the given
+           list of (addr, length) of registers that only the host writes."""
+        if not self.registers:
+            self.registers = RegisterMap(self, host_owned)
+        return self.registers
+
+    def stop_console_pump(self):
+        if self.pump:
+            self.pump.stop()
+            self.pump = None
+
+    def wait_for_console(self, pattern, timeout = 2.0, console = 1, do_print = False):
+        """Reads the console until the text contains 'pattern', or until 'timeout' seconds have passed.
+           Returns all text read, such that the caller can check for the pattern."""
+        read = self.user_read_console if console == 1 else self.user_read_console2
+        deadline = time.perf_counter() + timeout
+        text = ''
+        while True:
+            text += read()
+            if pattern in text or time.perf_counter() > deadline:
+                break
+            time.sleep(CONSOLE_POLL)
+        if do_print:
+            logger.info(text)
+        return text
+
+    def user_read_memory_blocks(self, addr, len, block = 8192):
+        # Generator, such that the caller can process each block while the next one is read
+        while len > 0:
+            now = len if len < block else block
+            yield self.user_read_memory(addr, now)
+            len -= now
+            addr += now
@@ -0,0 +1,401 @@
+# JTAG daemon, serving the socket protocol of _jtag_functions on top of jtag_direct.
+#
+# One daemon process keeps both FTDI channels open, one listening port per
+# channel, such that clients (the GUI) can come and go without reinitializing
+# USB. Every request starts with a big endian 16-bit opcode; every reply
+# starts with the result code and the low byte of the opcode. The daemon
+# remembers which bitstream each FPGA was configured with, such that loading
+# the same bitstream again is skipped while the FPGA still runs it.
+import os
+import socketserver
+import struct
+import threading
+import logging
+
+from _jtag_functions import *
+# After the protocol definitions, which come with a socket client of the same name
+from jtag_direct import JtagClient, JtagClientException, IO_FIFO_BATCH
+from spiflash import SpiFlash, JtagSpiBus
+from sharedbuf import SharedBuffer
+import daemons
+
+# create logger
+logger = logging.getLogger('Daemon')
+logger.setLevel(logging.INFO)
+ch = logging.StreamHandler()
+ch.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+logger.addHandler(ch)
+
+DAEMON_VERSION = 1
+PROGRESS_STEP = 1024 # bytes per progress reply; the client counts 100 per reply against the size in KB, giving percent
+
+# Ports of the former ecpprog daemons: interface A (DUT) and interface B (tester).
+# Clients find the daemons through the registry; port 0 takes any free port.
+CHANNELS = [ ('ftdi://ftdi:2232h/1', 6000), ('ftdi://ftdi:2232h/2', 5000) ]
+
+# Clients read a fixed size reply, also when it carries an error code; the
+# number of bytes that follows the code and opcode for each fixed size reply
+REPLY_PADDING = {
+    DAEMON_ID: 2,
+    ECP_READ_ID: 6,
+    ECP_UNIQUE_ID: 10,
+    USER_READ_ID: 6,
+    USER_READ_DEBUG: 6,
+    USER_READ_CONSOLE: 2,
+    USER_READ_CONSOLE2: 2,
+    USER_BATCH: 6,
+}
+
+class DaemonError(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, f"Daemon error {code:02x}")
+        self.code = code
+
+def read_exact(rfile, length):
+    data = rfile.read(length)
+    if len(data) < length:
+        raise ConnectionError("Client disconnected")
+    return data
+
+class JtagChannel:
+    """The JTAG client of one FTDI channel and what the daemon knows about the FPGA behind it."""
+    def __init__(self, url):
+        self.url = url
+        self.client = JtagClient(url)
+        self.bitstream = None # (path, mtime, user id) of the configured bitstream
+
+    def load_fpga(self, name):
+        if not os.path.exists(name):
+            raise DaemonError(CODE_FILE_NOT_FOUND)
+        key = (os.path.abspath(name), os.stat(name).st_mtime)
+        # Still configured with the same bitstream when the user JTAG still answers as it did after loading
+        if self.bitstream and self.bitstream[:2] == key and self.client.user_read_id() == self.bitstream[2]:
+            logger.info(f"{self.url}: {name} is already loaded")
+            return
+        self.bitstream = None
+        self.client.ecp_load_fpga(name)
+        self.bitstream = key + (self.client.user_read_id(),)
+
+    def clear_fpga(self):
+        self.bitstream = None
+        self.client.ecp_clear_fpga()
+
+    def enter_spi_background(self):
+        self.bitstream = None
+        self.client.ecp_enter_spi_background()
+
+    def refresh(self):
+        # Runs whatever design the flash holds
+        self.bitstream = None
+        self.client.ecp_refresh()
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        # Requests are read through a buffer, such that pipelined requests do not cost a system call each
+        socketserver.StreamRequestHandler.setup(self)
+        self.output = None # replies of a tagged request, collected
+        self.shared = None # buffer shared with the client
+        self.channel = self.server.channel
+        self.jtag = self.channel.client
+        self.commands = {
+            DAEMON_ID:               self.daemon_id,
+            ECP_LOADFPGA:            self.ecp_load_fpga,
+            ECP_PROGFLASH:           self.ecp_prog_flash,
+            ECP_READ_ID:             self.ecp_read_id,
+            ECP_UNIQUE_ID:           self.ecp_unique_id,
+            ECP_CLEARFPGA:           self.ecp_clear_fpga,
+            ECP_SPI_BACKGROUND:      self.ecp_spi_background,
+            ECP_SPI_TRANSFER:        self.ecp_spi_transfer,
+            ECP_REFRESH:             self.ecp_refresh,
+            USER_READ_ID:            self.user_read_id,
+            USER_READ_MEMORY:        self.user_read_memory,
+            USER_WRITE_MEMORY:       self.user_write_memory,
+            USER_READ_IO_REGISTERS:  self.user_read_io,
+            USER_WRITE_IO_REGISTERS: self.user_write_io,
+            USER_SET_IO:             self.user_set_io,
+            USER_READ_CONSOLE:       self.user_read_console,
+            USER_UPLOAD:             self.user_upload,
+            USER_RUN_APPL:           self.user_run_app,
+            USER_READ_DEBUG:         self.user_read_debug,
+            USER_READ_CONSOLE2:      self.user_read_console2,
+            USER_BATCH:              self.user_batch,
+            USER_ATTACH_BUFFER:      self.user_attach_buffer,
+            USER_WRITE_MEMORY_SHARED: self.user_write_memory_shared,
+            USER_READ_MEMORY_SHARED: self.user_read_memory_shared,
+            USER_PROG_FLASH_SPI:     self.user_prog_flash_spi,
+        }
+
+    def handle(self):
+        logger.info(f"Client connected from {self.client_address}")
+        try:
+            while True:
+                (opcode,) = self.recv_struct(">H")
+                if opcode == USER_TAGGED:
+                    self.execute_tagged()
+                else:
+                    self.send(self.execute(opcode))
+        except ConnectionError:
+            logger.info(f"Client disconnected from {self.client_address}")
+
+    def finish(self):
+        if self.shared:
+            self.shared.close()
+            self.shared = None
+        socketserver.StreamRequestHandler.finish(self)
+
+    def execute(self, opcode):
+        command = self.commands.get(opcode)
+        if not command:
+            # The parameters of an unknown command can't be skipped; the client has to reconnect
+            self.send(self.reply(opcode, CODE_UNKNOWN_COMMAND))
+            raise ConnectionError(f"Unknown command {opcode:04x}")
+        self.padding = REPLY_PADDING.get(opcode, 0)
+        try:
+            with self.jtag.lock:
+                return command(opcode)
+        except DaemonError as e:
+            code = e.code
+        except (JtagClientException, TimeoutError) as e:
+            logger.error(f"{opcode:04x} failed: {e}")
+            code = CODE_FIFO_ERROR
+        return self.reply(opcode, code, bytes(self.padding))
+
+    def execute_tagged(self):
+        # All replies of the request, including progress, are sent as one frame with the tag of the request
+        (tag, opcode) = self.recv_struct(">HH")
+        self.output = []
+        try:
+            self.output.append(self.execute(opcode))
+            data = b''.join(self.output)
+        finally:
+            self.output = None
+        self.send(struct.pack("<BBHL", CODE_OKAY, USER_TAGGED & 0xFF, tag, len(data)) + data)
+
+    def send(self, data):
+        if self.output is not None:
+            self.output.append(data)
+        else:
+            self.request.sendall(data)
+
+    def reply(self, opcode, code = CODE_OKAY, data = b''):
+        return bytes((code, opcode & 0xFF)) + data
+
+    def recv_struct(self, fmt):
+        return struct.unpack(fmt, read_exact(self.rfile, struct.calcsize(fmt)))
+
+    def recv_name(self):
+        (length,) = self.recv_struct("<B")
+        return read_exact(self.rfile, length).decode()
+
+    def daemon_id(self, opcode):
+        return self.reply(opcode, data = struct.pack("<H", DAEMON_VERSION))
+
+    def ecp_load_fpga(self, opcode):
+        (_zero, length) = self.recv_struct(">LB")
+        self.channel.load_fpga(read_exact(self.rfile, length).decode())
+        return self.reply(opcode)
+
+    def ecp_prog_flash(self, opcode):
+        # As ecpprog: the FPGA is cleared and the flash is programmed in background SPI mode, then the
+        # FPGA boots from it
+        self.channel.enter_spi_background()
+        try:
+            self.prog_flash(opcode, SpiFlash(self.jtag, JtagSpiBus(self.jtag)))
+        finally:
+            self.channel.refresh()
+        return self.reply(opcode)
+
+    def user_prog_flash_spi(self, opcode):
+        self.prog_flash(opcode, SpiFlash(self.jtag))
+        return self.reply(opcode)
+
+    def prog_flash(self, opcode, flash):
+        (addr,) = self.recv_struct("<L")
+        name = self.recv_name()
+        if not os.path.exists(name):
+            raise DaemonError(CODE_FILE_NOT_FOUND)
+        with open(name, "rb") as fi:
+            data = fi.read()
+        reported = [ 0 ]
+        def progress(done):
+            while done - reported[0] >= PROGRESS_STEP:
+                reported[0] += PROGRESS_STEP
+                self.send(self.reply(opcode, CODE_PROGRESS))
+        flash.program(addr, data, progress)
+        if flash.verify(addr, data):
+            raise DaemonError(CODE_VERIFY_ERROR)
+
+    def ecp_read_id(self, opcode):
+        return self.reply(opcode, data = struct.pack("<HL", 0, self.jtag.ecp_read_id()))
+
+    def ecp_unique_id(self, opcode):
+        (code, _lot, _wafer, _x, _y, _e) = self.jtag.ecp_read_unique_id()
+        return self.reply(opcode, data = struct.pack("<HQ", 0, code))
+
+    def ecp_clear_fpga(self, opcode):
+        self.channel.clear_fpga()
+        return self.reply(opcode)
+
+    def ecp_spi_background(self, opcode):
+        self.channel.enter_spi_background()
+        return self.reply(opcode)
+
+    def ecp_spi_transfer(self, opcode):
+        (length, read_length) = self.recv_struct("<LL")
+        data = read_exact(self.rfile, length)
+        self.padding = read_length
+        return self.reply(opcode, data = self.jtag.ecp_spi_transfer(data, read_length))
+
+    def ecp_refresh(self, opcode):
+        self.channel.refresh()
+        return self.reply(opcode)
+
+    def user_read_id(self, opcode):
+        return self.reply(opcode, data = struct.pack("<HL", 0, self.jtag.user_read_id()))
+
+    def user_read_debug(self, opcode):
+        return self.reply(opcode, data = struct.pack("<HL", 0, self.jtag.user_read_debug()))
+
+    def user_read_memory(self, opcode):
+        (addr, words) = self.recv_struct("<LL")
+        self.padding = words * 4
+        return self.reply(opcode, data = self.jtag.user_read_memory(addr, words * 4))
+
+    def user_write_memory(self, opcode):
+        (addr, length) = self.recv_struct("<LL")
+        self.jtag.user_upload_data(read_exact(self.rfile, length), addr)
+        return self.reply(opcode)
+
+    def user_attach_buffer(self, opcode):
+        (size,) = self.recv_struct("<L")
+        path = self.recv_name()
+        if self.shared:
+            self.shared.close()
+            self.shared = None
+        try:
+            self.shared = SharedBuffer(path, size)
+        except FileNotFoundError:
+            raise DaemonError(CODE_FILE_NOT_FOUND)
+        except (OSError, ValueError) as e:
+            logger.error(f"Can't map shared buffer {path}: {e}")
+            raise DaemonError(CODE_BAD_PARAMS)
+        return self.reply(opcode)
+
+    def shared_region(self):
+        (addr, offset, length) = self.recv_struct("<LLL")
+        if not self.shared or not self.shared.check(offset, length):
+            raise DaemonError(CODE_BAD_PARAMS)
+        return (addr, offset, length)
+
+    def user_write_memory_shared(self, opcode):
+        (addr, offset, length) = self.shared_region()
+        with self.shared.view[offset:offset + length] as data:
+            self.jtag.user_upload_data(data, addr)
+        return self.reply(opcode)
+
+    def user_read_memory_shared(self, opcode):
+        (addr, offset, length) = self.shared_region()
+        if length % 4:
+            raise DaemonError(CODE_BAD_PARAMS)
+        self.shared.view[offset:offset + length] = self.jtag.user_read_memory(addr, length)
+        return self.reply(opcode)
+
+    def user_read_io(self, opcode):
+        (addr, length) = self.recv_struct("<LL")
+        self.padding = length
+        return self.reply(opcode, data = self.jtag.user_read_io(addr, length))
+
+    def user_write_io(self, opcode):
+        (addr, length) = self.recv_struct("<LL")
+        self.jtag.user_write_io(addr, read_exact(self.rfile, length))
+        return self.reply(opcode)
+
+    def user_batch(self, opcode):
+        (count,) = self.recv_struct("<L")
+        entries = []
+        for _ in range(count):
+            (kind, addr, length) = self.recv_struct("<BLL")
+            if kind in (BATCH_WRITE_MEMORY, BATCH_WRITE_IO):
+                entries.append((kind, addr, read_exact(self.rfile, length)))
+            else:
+                entries.append((kind, addr, length))
+        result = bytearray()
+        io_ops = []
+        # Consecutive I/O register accesses are performed as one JTAG sequence
+        for (kind, addr, data) in entries:
+            if kind == BATCH_WRITE_IO:
+                io_ops.append((addr, data))
+                continue
+            if kind == BATCH_READ_IO:
+                for offset in range(0, data, IO_FIFO_BATCH):
+                    io_ops.append((addr + offset, min(IO_FIFO_BATCH, data - offset)))
+                continue
+            if io_ops:
+                result += self.jtag.user_batch_io(io_ops)
+                io_ops = []
+            if kind == BATCH_READ_MEMORY:
+                result += self.jtag.user_read_memory(addr, data)
+            elif kind == BATCH_WRITE_MEMORY:
+                self.jtag.user_upload_data(data, addr)
+            else:
+                raise DaemonError(CODE_BAD_PARAMS)
+        if io_ops:
+            result += self.jtag.user_batch_io(io_ops)
+        return self.reply(opcode, data = struct.pack("<HL", 0, len(result)) + result)
+
+    def user_set_io(self, opcode):
+        (value,) = self.recv_struct("<L")
+        self.jtag.user_set_io(value & 0xFF)
+        return self.reply(opcode)
+
+    def console_reply(self, opcode, text):
+        data = text.encode('cp1252', errors = 'replace')
+        return self.reply(opcode, data = struct.pack("<H", len(data)) + data)
+
+    def user_read_console(self, opcode):
+        return self.console_reply(opcode, self.jtag.user_read_console())
+
+    def user_read_console2(self, opcode):
+        return self.console_reply(opcode, self.jtag.user_read_console2())
+
+    def user_upload(self, opcode):
+        (addr,) = self.recv_struct("<L")
+        name = self.recv_name()
+        if not os.path.exists(name):
+            raise DaemonError(CODE_FILE_NOT_FOUND)
+        self.jtag.user_upload(name, addr)
+        return self.reply(opcode)
+
+    def user_run_app(self, opcode):
+        (addr,) = self.recv_struct("<L")
+        self.jtag.user_run_app(addr)
+        return self.reply(opcode)
+
+class DaemonServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, channel, port, host = 'localhost'):
+        self.channel = channel
+        socketserver.ThreadingTCPServer.__init__(self, (host, port), DaemonHandler)
+
+def serve(channels = CHANNELS):
+    """Opens all channels, serves each on its own port and registers them, until interrupted."""
+    servers = [ DaemonServer(JtagChannel(url), port) for (url, port) in channels ]
+    threads = [ threading.Thread(target = server.serve_forever, daemon = True) for server in servers ]
+    try:
+        for (thread, server) in zip(threads, servers):
+            thread.start()
+            daemons.register(server.channel.url, server.server_address)
+            logger.info(f"Serving {server.channel.url} on port {server.server_address[1]}")
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for server in servers:
+            server.shutdown()
+    finally:
+        for server in servers:
+            daemons.unregister(server.channel.url)
+
+if __name__ == '__main__':
+    serve()
@@ -4,6 +4,11 @@ import time
 import logging
 import struct
 import os
+import threading
+from iocmd import io_read_command, io_write_command
+from console import CONSOLE_FIFOS
+from jtag_common import JtagClientException, ClientHelpers, exclusive
+from bulk import mapped_file, chunks, stack_data
 
 # create logger
 logger = logging.getLogger('JTAG')
@@ -51,13 +56,12 @@ LSC_PROG_FEABITS = 0xF8 # 24 bits - Program User Feature Bits, such as CFG port
 LSC_READ_FEABITS = 0xFB # 24 bits - Read User Feature Bits, such as CFH port and pin persistence, PWD_EN, PWD_ALL, DEC_ONLY, Feature Row Lock etc. 
 LSC_PROG_OTP = 0xF9 # 24 bits - Program OTP bits, to set Memory Sectors One Time Programmable 
 LSC_READ_OTP = 0xFA # 24 bits - Read OTP bits setting 
+LSC_BACKGROUND_SPI = 0x3A # 16 bits - Connect the SPI flash to the JTAG data register, with the 0x68FE key
 LSC_USER1 = 0x32
 LSC_USER2 = 0x38
 
-class JtagClientException(Exception):
-    pass
-
-class JtagClient:
+IO_FIFO_BATCH = 240 # Maximum number of I/O read bytes that are queued before the fifo is read
+class JtagClient(ClientHelpers):
     def __init__(self, url = 'ftdi://ftdi:2232h/1'):
         self.url = url
         self.jtag = JtagEngine(trst=False, frequency=3e6)
@@ -65,6 +69,9 @@ class JtagClient:
         self.jtag.configure(url)
         self.jtag.reset()
         self._reverse = None
+        self.lock = threading.RLock()
+        self.pump = None
+        self.registers = None
 
     def jtag_clocks(self, clocks):
         cmd = bytearray(3)
@@ -80,6 +87,7 @@ class JtagClient:
             cmd[1] = cnt
             self.jtag._ctrl._stack_cmd(cmd[0:2])
         
+    @exclusive
     def ecp_read_id(self):
         self.jtag.reset()
         idcode = self.jtag.read_dr(32)
@@ -87,6 +95,7 @@ class JtagClient:
         logger.info(f"IDCODE (reset): {int(idcode):08x}")
         return int(idcode)
 
+    @exclusive
     def ecp_read_unique_id(self):
         self.jtag.reset()
         #bs = BitSequence(bytes_ = b'\x19')
@@ -107,12 +116,14 @@ class JtagClient:
         logger.info(f"  Wafer X/Y/E: {x}, {y}, {e}")
         return (code, lot, wafer, x, y, e)
 
+    @exclusive
     def ecp_jtag_cmd8(self, cmd, param):
         self.jtag.write_ir(BitSequence(cmd, False, 8))
         self.jtag.write_dr(BitSequence(param, False, 8))
         self.jtag.go_idle()
         self.jtag_clocks(32)
 
+    @exclusive
     def read_status_register(self):
         bs = BitSequence(LSC_READ_STATUS, False, 8)
         self.jtag.write_ir(bs)
@@ -138,6 +149,10 @@ class JtagClient:
         return result
 
     def ecp_load_fpga(self, filename):
+        # The console fifos are gone until the new design runs; stopped first, as the pump may wait for the lock
+        self.stop_console_pump()
+        if self.registers:
+            self.registers.invalidate()
 	    # Reset
         logger.info("reset..")
         self.jtag.reset()
@@ -149,18 +164,13 @@ class JtagClient:
         # Program
         logger.info("programming..");
         self.jtag.write_ir(BitSequence(LSC_BITSTREAM_BURST, False, 8))
-        with open(filename, "rb") as f:
+        with mapped_file(filename) as view:
             self.jtag.change_state('shift_dr')
-            while(True):
-                buffer = f.read(16384)
-                if len(buffer) <= 0:
-                    break
-
+            for (_offset, buffer) in chunks(view):
                 olen = len(buffer)-1
-                cmd = bytearray((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
+                cmd = bytes((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
                           (olen >> 8) & 0xff))
-                cmd.extend(buffer)
-                self.jtag._ctrl._stack_cmd(cmd)
+                stack_data(self.jtag, cmd, buffer)
 
         self.jtag.change_state('update_dr')
         self.jtag.write_ir(BitSequence(ISC_DISABLE, False, 8))
@@ -168,6 +178,39 @@ class JtagClient:
         self.jtag_clocks(32)
         self.read_status_register()	
 
+    @exclusive
+    def ecp_enter_spi_background(self):
+        """Clears the FPGA, such that it releases the SPI flash, and connects the flash to the JTAG data register,
+           as ecpprog does to program the flash. The flash is selected while the TAP is in shift-DR."""
+        self.stop_console_pump()
+        if self.registers:
+            self.registers.invalidate()
+        self.jtag.reset()
+        self.ecp_jtag_cmd8(ISC_ENABLE, 0)
+        self.ecp_jtag_cmd8(ISC_ERASE, 0)
+        self.ecp_jtag_cmd8(ISC_DISABLE, 0)
+        self.jtag.write_ir(BitSequence(LSC_BACKGROUND_SPI, False, 8))
+        self.jtag.write_dr(BitSequence(0x68FE, False, 16))
+        self.jtag.go_idle()
+        self.jtag_clocks(32)
+
+    @exclusive
+    def ecp_spi_transfer(self, data, read_length = 0):
+        """Performs one SPI transaction in background SPI mode: sends 'data', then reads 'read_length' bytes."""
+        # SPI sends the most significant bit first, the TAP shifts the least significant bit first
+        out = self.bitreverse(bytes(data) + bytes(read_length))
+        self.jtag.change_state('shift_dr')
+        rb = self.jtag.shift_register(BitSequence(bytes_ = out, msby = False))
+        self.jtag.go_idle()
+        return bytes(self.bitreverse(rb.tobytes(msby = False)[len(data):]))
+
+    @exclusive
+    def ecp_refresh(self):
+        # Reconfigures the FPGA from the flash, as a pulse on PROGRAMN does
+        self.jtag.write_ir(BitSequence(LSC_REFRESH, False, 8))
+        self.jtag.go_idle()
+        self.jtag_clocks(32)
+
     def reverse_file(self, infile, outfile):
         with open(infile, "rb") as fi:
             with open(outfile, "wb") as fo:
@@ -195,6 +238,7 @@ class JtagClient:
         inp = BitSequence(0, length = bits)
         return self.jtag.shift_register(inp)
 
+    @exclusive
     def user_read_id(self):
         self.set_user_ir(0)
         user_id = int(self.read_user_data(32))
@@ -202,11 +246,13 @@ class JtagClient:
         logger.info(f"UserID: {user_id:08x}")
         return user_id
 
+    @exclusive
     def user_set_io(self, value):
         self.set_user_ir(2)
         self.jtag.shift_and_update_register(BitSequence(value, False, 8))
         self.jtag.go_idle()
 
+    @exclusive
     def read_fifo(self, expected, cmd = 4, stopOnEmpty = False, readAll = False):
         available = 0
         readback = b''
@@ -247,12 +293,16 @@ class JtagClient:
 
 #################
     def ecp_clear_fpga(self):
+        self.stop_console_pump()
+        if self.registers:
+            self.registers.invalidate()
         self.jtag.reset()
         self.ecp_jtag_cmd8(ISC_ENABLE, 0)
         self.ecp_jtag_cmd8(ISC_ERASE, 0)
         self.ecp_jtag_cmd8(LSC_RESET_CRC, 0)
         self.read_status_register()
     
+    @exclusive
     def user_read_debug(self):
         self.set_user_ir(3)
         rb = self.jtag.shift_and_update_register(BitSequence(0, False, 32))
@@ -260,50 +310,33 @@ class JtagClient:
         self.jtag.go_idle()
         return int(rb)
     
-    def user_read_console(self, do_print = False):
-        raw = self.read_fifo(expected = 1000, cmd = 10, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
-        if do_print:
-            logger.info(text)
-        return text
-    
-    def user_read_console2(self, do_print = False):
-        raw = self.read_fifo(expected = 1000, cmd = 11, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            if raw[i] < 0x20 and raw[i] != 0x0a:
-                text[i] = 0x3f
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
-        if do_print:
-            logger.info(text)
-        return text
-    
+    @exclusive
+    def read_console_fifo(self, console = 1):
+        return self.read_fifo(expected = 1000, cmd = CONSOLE_FIFOS[console], stopOnEmpty = True)
+
     def user_upload(self, name, addr):
-        bytes_read = 0
-        with open(name, "rb") as fi:
+        with mapped_file(name) as view:
             logger.info(f"Uploading {name} to address {addr:08x}")
-            while(True):
-                buffer = fi.read(16384)
-                if len(buffer) <= 0:
-                    break
-                bytes_read += len(buffer)
-                self.user_write_memory(addr, buffer)
-                addr += 16384
+            bytes_read = len(view)
+            for (offset, chunk) in chunks(view):
+                self.user_write_memory(addr + offset, chunk)
 
         if bytes_read == 0:
             logger.error(f"Reading file {name} failed -> Can't upload to board.")
             raise JtagClientException("Failed to upload applictation")
 
+    def user_upload_data(self, data, addr):
+        for (offset, chunk) in chunks(memoryview(data)):
+            self.user_write_memory(addr + offset, chunk)
+
+    @exclusive
     def user_run_app(self, addr):
         magic = struct.pack("<LL", addr, 0x1571babe)
         self.user_set_io(0x80) # Reset
         self.user_write_memory(0xF8, magic)
         self.user_set_io(0x00) # Unreset
     
+    @exclusive
     def user_write_memory(self, addr, buffer):
         addrbytes = struct.pack("<L", addr)
         command = bytearray([ addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6, addrbytes[3], 7, 0x80, 0x01])
@@ -311,12 +344,12 @@ class JtagClient:
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.set_user_ir(6)
         olen = len(buffer)-1
-        cmd = bytearray((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
+        cmd = bytes((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
                     (olen >> 8) & 0xff))
-        cmd.extend(buffer)
-        self.jtag._ctrl._stack_cmd(cmd)
+        stack_data(self.jtag, cmd, buffer)
         self.jtag.go_idle()
     
+    @exclusive
     def user_read_memory(self, addr, len):
         result = b''
         #logger.info(f"Reading {len} bytes from address {addr:08x}...")
@@ -346,24 +379,60 @@ class JtagClient:
         valbytes = self.user_read_memory(addr, 4)
         return struct.unpack("<L", valbytes)[0]
 
+    @exclusive
     def user_write_io(self, addr, bytes):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for b in bytes:
-            command += struct.pack("BB", b, 0x0f)
+        command = io_write_command(addr, bytes)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.jtag.go_idle()
 
+    @exclusive
     def user_read_io(self, addr, len):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for i in range(len):
-            command += b'\x00\x0d'
+        command = io_read_command(addr, len)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         return self.read_fifo(len)
 
+    @exclusive
+    def user_queue_io(self, ops):
+        """Sends a list of (addr, bytes) writes and (addr, length) reads of I/O registers as one command,
+           without waiting for the read data. Returns the number of bytes the reads put into the fifo."""
+        command = bytearray()
+        expected = 0
+        for (addr, data) in ops:
+            if isinstance(data, int):
+                command += io_read_command(addr, data)
+                expected += data
+            else:
+                io_write_command(addr, data, command)
+        self.set_user_ir(5)
+        self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
+        self.jtag.go_idle()
+        self.jtag._ctrl.sync()
+        return expected
+
+    @exclusive
+    def user_batch_io(self, ops):
+        """Performs a list of I/O register writes and reads in one go and returns all read data concatenated."""
+        readback = b''
+        batch = []
+        pending = 0
+        # The read data has to fit in the fifo, of which the fill level is reported in 8 bits
+        for op in ops:
+            length = op[1] if isinstance(op[1], int) else 0
+            if pending + length > IO_FIFO_BATCH:
+                self.user_queue_io(batch)
+                readback += self.read_fifo(pending)
+                batch = []
+                pending = 0
+            batch.append(op)
+            pending += length
+        if batch:
+            self.user_queue_io(batch)
+            if pending:
+                readback += self.read_fifo(pending)
+        return readback
+
 
 if __name__ == '__main__':
     logger.addHandler(ch)
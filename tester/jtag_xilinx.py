@@ -4,7 +4,10 @@ import time
 import logging
 import struct
 import os
-import math
+from iocmd import io_read_command, io_write_command
+from console import decode_console
+from bulk import mapped_file, chunks, stack_data
+from waveform import AUDIO_LOOPBACK
 
 # create logger
 logger = logging.getLogger('JTAG')
@@ -138,18 +141,13 @@ class JtagClient:
         # Program
         logger.info("programming..");
         self.jtag.write_ir(BitSequence(XILINX_CFG_IN, False, 6))
-        with open(filename, "rb") as f:
+        with mapped_file(filename) as view:
             self.jtag.change_state('shift_dr')
-            while(True):
-                buffer = f.read(16384)
-                if len(buffer) <= 0:
-                    break
-
+            for (_offset, buffer) in chunks(view):
                 olen = len(buffer)-1
-                cmd = bytearray((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
+                cmd = bytes((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
                           (olen >> 8) & 0xff))
-                cmd.extend(buffer)
-                self.jtag._ctrl._stack_cmd(cmd)
+                stack_data(self.jtag, cmd, buffer)
 
         self.jtag.change_state('update_dr')
         self.jtag.go_idle()
@@ -257,37 +255,24 @@ class JtagClient:
     
     def user_read_console(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 10, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
+        text = decode_console(raw, 1)
         if do_print:
             logger.info(text)
         return text
     
     def user_read_console2(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 11, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            if raw[i] < 0x20 and raw[i] != 0x0a:
-                text[i] = 0x3f
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
+        text = decode_console(raw, 2)
         if do_print:
             logger.info(text)
         return text
     
     def user_upload(self, name, addr):
-        bytes_read = 0
-        with open(name, "rb") as fi:
+        with mapped_file(name) as view:
             logger.info(f"Uploading {name} to address {addr:08x}")
-            while(True):
-                buffer = fi.read(16384)
-                if len(buffer) <= 0:
-                    break
-                bytes_read += len(buffer)
-                self.user_write_memory(addr, buffer + b'\x00\x00\x00\x00\x00\x00\x00\x00')
-                addr += 16384
+            bytes_read = len(view)
+            for (offset, chunk) in chunks(view):
+                self.user_write_memory(addr + offset, chunk, padding = 8)
             logger.info(f"Uploaded {bytes_read:06x} bytes.")
 
         if bytes_read == 0:
@@ -325,17 +310,17 @@ class JtagClient:
         if reset:
             self.user_set_outputs(0x80) # Unreset
     
-    def user_write_memory(self, addr, buffer):
+    def user_write_memory(self, addr, buffer, padding = 0):
         addrbytes = struct.pack("<L", addr)
         command = bytearray([ addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6, addrbytes[3], 7, 0x80, 0x01])
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.set_user_ir(6)
-        olen = len(buffer)-1
-        cmd = bytearray((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
+        # 'padding' zero bytes are sent after the buffer
+        olen = len(buffer) + padding - 1
+        cmd = bytes((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
                     (olen >> 8) & 0xff))
-        cmd.extend(buffer)
-        self.jtag._ctrl._stack_cmd(cmd)
+        stack_data(self.jtag, cmd, buffer, bytes(padding))
         self.jtag.go_idle()
     
     def user_read_memory(self, addr, len):
@@ -373,19 +358,13 @@ class JtagClient:
         return struct.unpack("<L", valbytes)[0]
 
     def user_write_io(self, addr, bytes):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for b in bytes:
-            command += struct.pack("BB", b, 0x0f)
+        command = io_write_command(addr, bytes)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.jtag.go_idle()
 
     def user_read_io(self, addr, len):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for i in range(len):
-            command += b'\x00\x0d'
+        command = io_read_command(addr, len)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         return self.read_fifo(len)
@@ -571,17 +550,8 @@ def init_ddr2(j):
     j.user_write_int32(0x100, 0x87654321)
     
 def write_sine_wave(jtag):
-    scale = math.pow(2.0, 31) * 0.9
-    data = b''
-    for i in range(192):
-        phase = i * (2. * math.pi / 48.) # 1000 Hz
-        sampleL = scale * math.sin(phase)
-        phase = i * (2. * math.pi / 64.) # 750 Hz
-        sampleR = scale * math.sin(phase)
-        data += struct.pack("<ll", int(sampleL), int(sampleR))
-
-    ## data should now have 192 samples
-    jtag.user_write_memory(0x1100000, data)
+    # 1000 Hz on the left, 750 Hz on the right; 192 samples
+    jtag.user_write_memory(0x1100000, AUDIO_LOOPBACK.data)
 
 def prog_fpga(logger, j, sel):
     start_time = time.perf_counter()
@@ -0,0 +1,108 @@
+# Manifest of the binary images that are programmed into the flash.
+#
+# Every image in the binaries directory is processed once: its size, SHA-256
+# and the CRC32 of every flash sector, against which the flash is verified,
+# are stored in a cache file next to the images, together with the flash
+# address the image is programmed to. An entry is only rebuilt when
+# the size or modification time of its file changes. The image data itself is
+# read at most once per run and kept in memory.
+import base64
+import hashlib
+import json
+import logging
+import os
+import struct
+import zlib
+
+# create logger
+logger = logging.getLogger('Manifest')
+logger.setLevel(logging.INFO)
+
+MANIFEST_FILE = 'manifest.json'
+SECTOR_SIZE = 4096
+
+class ImageInfo:
+    def __init__(self, name, entry, manifest):
+        self.name = name
+        self.size = entry['size']
+        self.sha256 = entry['sha256']
+        self.address = entry.get('address')
+        crcs = base64.b64decode(entry['crcs'])
+        self.sector_crcs = list(struct.unpack(f"<{len(crcs) // 4}L", crcs))
+        self.manifest = manifest
+
+    @property
+    def data(self):
+        return self.manifest.data(self.name)
+
+def describe(data, address):
+    crcs = [ zlib.crc32(data[i:i + SECTOR_SIZE]) for i in range(0, len(data), SECTOR_SIZE) ]
+    return {
+        'size': len(data),
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'address': address,
+        'crcs': base64.b64encode(struct.pack(f"<{len(crcs)}L", *crcs)).decode(),
+    }
+
+class Manifest:
+    def __init__(self, directory = 'binaries', addresses = { }, filename = MANIFEST_FILE):
+        self.directory = directory
+        self.addresses = addresses # load address per file name
+        self.filename = os.path.join(directory, filename)
+        self.entries = { }
+        self.images = { }
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as fi:
+                self.entries = json.load(fi)
+        except (OSError, ValueError):
+            self.entries = { }
+
+    def save(self):
+        try:
+            with open(self.filename, "w") as fo:
+                json.dump(self.entries, fo, separators = (',', ':'))
+        except OSError as e:
+            logger.warning(f"Could not store image manifest: {e}")
+
+    def refresh(self):
+        """Brings the manifest up to date with the files in the directory."""
+        names = sorted(n for n in os.listdir(self.directory) if n != os.path.basename(self.filename))
+        changed = False
+        for name in names:
+            changed |= self.update(name)
+        for name in list(self.entries):
+            if name not in names:
+                del self.entries[name]
+                changed = True
+        if changed:
+            self.save()
+
+    def update(self, name):
+        """Processes an image again when its file changed; returns True when the entry changed."""
+        st = os.stat(os.path.join(self.directory, name))
+        entry = self.entries.get(name)
+        address = self.addresses.get(name)
+        if entry and entry['mtime'] == st.st_mtime and entry['size'] == st.st_size and entry.get('address') == address:
+            return False
+        logger.info(f"Processing image {name}")
+        entry = describe(self.data(name, reload = True), address)
+        entry['mtime'] = st.st_mtime
+        self.entries[name] = entry
+        return True
+
+    def data(self, name, reload = False):
+        name = os.path.basename(name)
+        if reload or name not in self.images:
+            with open(os.path.join(self.directory, name), "rb") as fi:
+                self.images[name] = fi.read()
+        return self.images[name]
+
+    def image(self, name):
+        """Returns the ImageInfo of an image, by file name or path. Only this image is checked for changes on disk."""
+        name = os.path.basename(name)
+        if self.update(name):
+            self.save()
+        return ImageInfo(name, self.entries[name], self)
@@ -0,0 +1,64 @@
+# Localization of DDR2 faults from the blocks written and read back by the memory test.
+#
+# Address line faults show up as aliasing: a block that is read back contains
+# the data that was written to another address. Data line (DQ) faults show up
+# as bit errors in the same bit position of every word. The DDR2 device on the
+# board is 16 bits wide, so DQ n is bit n of each little endian 16-bit word.
+import numpy as np
+
+DQ_WIDTH = 16
+
+def bit_list(value):
+    return [ i for i in range(value.bit_length()) if value & (1 << i) ]
+
+def find_aliases(addresses, expected, actual):
+    """Returns a list of (read address, written address) pairs, for all blocks that read back the data written to another address."""
+    same = (actual[:, None, :] == expected[None, :, :]).all(axis = 2)
+    np.fill_diagonal(same, False)
+    return [ (addresses[i], addresses[j]) for (i, j) in zip(*np.nonzero(same)) ]
+
+def data_line_faults(expected, actual, width = DQ_WIDTH):
+    """Returns (error counts per DQ, stuck at 0, stuck at 1, list of shorted DQ pairs)."""
+    dtype = { 8: '<u1', 16: '<u2', 32: '<u4' }[width]
+    shifts = np.arange(width)
+    exp = ((expected.reshape(-1).view(dtype)[:, None] >> shifts) & 1).astype(bool)
+    act = ((actual.reshape(-1).view(dtype)[:, None] >> shifts) & 1).astype(bool)
+    counts = (exp ^ act).sum(axis = 0)
+    failing = counts > 0
+    stuck0 = failing & ~act.any(axis = 0)
+    stuck1 = failing & act.all(axis = 0)
+    # Two lines are shorted when they always read the same, while they were written differently
+    shorted = (act[:, :, None] == act[:, None, :]).all(axis = 0) & (exp[:, :, None] != exp[:, None, :]).any(axis = 0)
+    shorted &= failing[:, None] | failing[None, :]
+    pairs = [ (int(a), int(b)) for (a, b) in zip(*np.nonzero(np.triu(shorted, 1))) ]
+    return (counts, stuck0, stuck1, pairs)
+
+def analyze_blocks(addresses, expected, actual, width = DQ_WIDTH):
+    """Compares all written and read blocks at once and returns a list of findings for the technician."""
+    exp = np.frombuffer(b''.join(expected), dtype = np.uint8).reshape(len(expected), -1)
+    act = np.frombuffer(b''.join(actual), dtype = np.uint8).reshape(len(actual), -1)
+    findings = []
+
+    aliases = find_aliases(addresses, exp, act)
+    for (read, written) in aliases:
+        findings.append(f"Address {read:08x} returns data written to {written:08x}: address bit(s) {bit_list(read ^ written)} stuck or shorted")
+
+    # Blocks that alias are explained by the address lines; the rest tells about the data lines
+    aliased = set(addresses.index(read) for (read, _) in aliases)
+    keep = [ i for i in range(len(addresses)) if i not in aliased ]
+    if keep:
+        (counts, stuck0, stuck1, pairs) = data_line_faults(exp[keep], act[keep], width)
+        for dq in np.flatnonzero(stuck0):
+            findings.append(f"DQ{dq} stuck at 0")
+        for dq in np.flatnonzero(stuck1):
+            findings.append(f"DQ{dq} stuck at 1")
+        for (a, b) in pairs:
+            findings.append(f"DQ{a} shorted to DQ{b}")
+        explained = set(np.flatnonzero(stuck0 | stuck1)) | set(dq for pair in pairs for dq in pair)
+        for dq in np.flatnonzero(counts):
+            if dq not in explained:
+                findings.append(f"DQ{dq} has {counts[dq]} bit errors")
+
+    if not findings and (exp != act).any():
+        findings.append("Errors do not match a single address or data line")
+    return findings
@@ -0,0 +1,93 @@
+import os
+import json
+import logging
+
+# create logger
+logger = logging.getLogger('Ordering')
+logger.setLevel(logging.INFO)
+
+STATS_FILE = '~/.config/u2pl_test_stats.json'
+DEFAULT_DURATION = 1.0 # seconds, used for tests that have never been timed
+
+class TestStatistics:
+    """Keeps per-test run count, failure count and average duration across runs. Runs taken from the
+       database have no duration, so the runs that were timed are counted separately."""
+    def __init__(self, filename = STATS_FILE):
+        self.filename = os.path.expanduser(filename)
+        self.stats = { }
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, "r") as fi:
+                self.stats = json.load(fi)
+        except (OSError, ValueError):
+            self.stats = { }
+
+    def save(self):
+        try:
+            with open(self.filename, "w") as fo:
+                json.dump(self.stats, fo, indent = 1)
+        except OSError as e:
+            logger.warning(f"Could not store test statistics: {e}")
+
+    def _entry(self, name):
+        return self.stats.setdefault(name, { 'runs': 0, 'fails': 0, 'time': 0.0, 'timed': 0 })
+
+    def record(self, name, duration, failed):
+        entry = self._entry(name)
+        entry['runs'] += 1
+        entry['time'] += duration
+        entry['timed'] = entry.get('timed', 0) + 1
+        if failed:
+            entry['fails'] += 1
+
+    def seed_from_db(self, db, names):
+        # The u2pl_tests table only holds the numbers of failed tests, so it
+        # can only give failure counts, not durations. Only used when there
+        # is no local history yet. After a critical failure the remaining
+        # tests were skipped, and the critical test itself is not in the
+        # list; which tests ran is not recorded, so those boards are left
+        # out. Critical failures are therefore not counted.
+        if self.stats:
+            return
+        for item in db.scan_test_results():
+            if item.get('critical'):
+                continue
+            failed = [ n for n in item.get('failed', '').split(',') if n ]
+            for name in names:
+                entry = self._entry(name)
+                entry['runs'] += 1
+                if name[5:8] in failed:
+                    entry['fails'] += 1
+
+    def failure_rate(self, name):
+        # Laplace smoothing, such that unknown tests start at 50%
+        entry = self.stats.get(name, { 'runs': 0, 'fails': 0 })
+        return (entry['fails'] + 1) / (entry['runs'] + 2)
+
+    def duration(self, name):
+        entry = self.stats.get(name)
+        if not entry or not entry.get('timed'):
+            return DEFAULT_DURATION
+        return entry['time'] / entry['timed']
+
+    def score(self, name):
+        # Rejection probability per second spent; running tests in order of
+        # descending score minimizes the expected time until the first failure.
+        return self.failure_rate(name) / max(self.duration(name), 0.001)
+
+def order_tests(names, dependencies, stats):
+    """Returns the test names such that all dependencies are honored and the cheapest, most likely to fail test that is ready runs first."""
+    names = list(names)
+    done = set()
+    ordered = [ ]
+    while len(ordered) < len(names):
+        ready = [ n for n in names if n not in done and all(d in done or d not in names for d in dependencies.get(n, [])) ]
+        if not ready:
+            raise ValueError("Circular test dependencies: " + ', '.join(n for n in names if n not in done))
+        # max() returns the first on equal score, so without history the original order is kept
+        best = max(ready, key = stats.score)
+        ordered.append(best)
+        done.add(best)
+    return ordered
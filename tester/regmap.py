@@ -0,0 +1,60 @@
+# Write-combining access to the I/O registers of a JTAG client.
+#
+# Writes are staged in order and sent as one JTAG shift, in which writes to
+# consecutive addresses are merged into one burst (the I/O address increments
+# after every data byte). Staging lasts for the duration of a 'with' block on
+# the map; outside of a block every write is sent right away.
+#
+# Registers that only the host writes, such as direction registers, are kept
+# in a shadow copy, and writing the value such a register already has is
+# skipped. The shadow is only valid as long as all writes to these registers
+# go through the map, and it is cleared when the FPGA is reloaded.
+
+class RegisterMap:
+    def __init__(self, client, host_owned = ()):
+        self.client = client
+        self.host_owned = set()
+        for (addr, length) in host_owned:
+            self.host_owned.update(range(addr, addr + length))
+        self.shadow = {}
+        self.staged = [] # (addr, value) in order of writing
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *args):
+        self.depth -= 1
+        if self.depth == 0:
+            self.flush()
+
+    def write(self, addr, data):
+        for (i, value) in enumerate(data):
+            a = addr + i
+            if a in self.host_owned:
+                if self.shadow.get(a) == value:
+                    continue
+                self.shadow[a] = value
+            self.staged.append((a, value))
+        if self.depth == 0:
+            self.flush()
+
+    def bursts(self):
+        """Returns the staged writes as a list of (addr, bytes), merging consecutive addresses."""
+        ops = []
+        for (addr, value) in self.staged:
+            if ops and ops[-1][0] + len(ops[-1][1]) == addr:
+                ops[-1][1].append(value)
+            else:
+                ops.append((addr, bytearray((value,))))
+        return ops
+
+    def flush(self):
+        if self.staged:
+            ops = self.bursts()
+            self.staged = []
+            self.client.user_queue_io(ops)
+
+    def invalidate(self):
+        self.shadow = {}
@@ -0,0 +1,54 @@
+# Shared memory between a JTAG daemon client and the daemon, for bulk data.
+#
+# The client creates a file in memory backed storage (/dev/shm when there is
+# one), maps it, and tells the daemon its path. Once the daemon has mapped it
+# too, the client removes the file; the mapping stays valid in both processes
+# until they close it, so nothing is left behind when either of them dies.
+# Memory reads and writes then only send the location of the data in the
+# buffer over the socket; the client uses the buffer as a ring of slots, see
+# _jtag_functions.
+import mmap
+import os
+import tempfile
+
+SHARED_BUFFER_SIZE = 4 << 20
+SHARED_SLOT = 256 << 10 # bytes per request; the buffer holds a ring of these
+SHARED_THRESHOLD = 4096 # transfers of at least this many bytes go through the shared buffer
+
+def shared_directory():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class SharedBuffer:
+    def __init__(self, path, size, create = False):
+        self.path = path
+        self.size = size
+        with open(path, "w+b" if create else "r+b") as f:
+            if create:
+                f.truncate(size)
+            elif os.fstat(f.fileno()).st_size < size:
+                raise ValueError(f"Shared buffer {path} is smaller than {size} bytes")
+            self.mm = mmap.mmap(f.fileno(), size)
+        self.view = memoryview(self.mm)
+
+    @classmethod
+    def create(cls, size = SHARED_BUFFER_SIZE):
+        (fd, path) = tempfile.mkstemp(prefix = 'jtag-', dir = shared_directory())
+        os.close(fd)
+        try:
+            return cls(path, size, create = True)
+        except OSError:
+            os.unlink(path)
+            raise
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def check(self, offset, length):
+        return offset + length <= self.size
+
+    def close(self):
+        self.view.release()
+        self.mm.close()
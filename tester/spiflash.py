@@ -0,0 +1,150 @@
+# SPI flash access over the I/O bus of the test FPGA, or over JTAG in the
+# background SPI mode of the ECP5.
+#
+# The SPI master has a data register, mirrored on four consecutive addresses
+# from 0x60200, and a control register at 0x60208 that drives the chip select.
+# Every byte written to the data register is sent; every byte read from it is
+# clocked in while 0xFF is sent. A complete SPI transaction (chip select,
+# opcode, address, dummy bytes, read data, deselect) is compiled into one list
+# of I/O operations, which is sent as a single batched JTAG sequence.
+#
+# In background SPI mode (jtag_direct.ecp_enter_spi_background), the flash
+# is wired to the JTAG data register instead; that needs no design in the
+# FPGA, as it is cleared first.
+#
+# Verification reads the flash back in blocks and compares the CRC of each
+# block with the CRC of the same block of the image; only for failing blocks
+# the data itself is compared, to find the first differing byte.
+import time
+import zlib
+
+SPI_DATA = 0x60200
+SPI_CONTROL = 0x60208
+SPI_WINDOW = 4 # addresses on which the data register is mirrored
+SPI_SELECT = b'\x01'
+SPI_DESELECT = b'\x03'
+
+FLASH_READ = 0x03
+FLASH_WRITE_ENABLE = 0x06
+FLASH_PAGE_PROGRAM = 0x02
+FLASH_SECTOR_ERASE = 0x20
+FLASH_READ_STATUS = 0x05
+FLASH_JEDEC_ID = 0x9F
+FLASH_UNIQUE_ID = 0x4B
+FLASH_BUSY = 0x01
+
+VERIFY_BLOCK = 4096 # bytes per read transaction and CRC
+SECTOR = 4096
+PAGE = 256
+
+class SpiBus:
+    def __init__(self, client, data = SPI_DATA, control = SPI_CONTROL):
+        self.client = client
+        self.data = data
+        self.control = control
+
+    def transaction_ops(self, command, read_length = 0, dummy = 0):
+        """Returns the I/O operations of one SPI transaction, in which 'read_length' bytes are read."""
+        # Always deselect first: the DUT CPU drives the chip select too, so its state is never known here
+        ops = [ (self.control, SPI_DESELECT), (self.data, b'\xff'), (self.control, SPI_SELECT) ]
+        out = bytes(command) + bytes(dummy)
+        for i in range(0, len(out), SPI_WINDOW):
+            ops.append((self.data, out[i:i + SPI_WINDOW]))
+        for i in range(0, read_length, SPI_WINDOW):
+            ops.append((self.data, min(SPI_WINDOW, read_length - i)))
+        ops.append((self.control, SPI_DESELECT))
+        return ops
+
+    def transfer(self, command, read_length = 0, dummy = 0):
+        """Performs one SPI transaction and returns the bytes read."""
+        return self.client.user_batch_io(self.transaction_ops(command, read_length, dummy))
+
+class JtagSpiBus:
+    def __init__(self, client):
+        self.client = client
+
+    def transfer(self, command, read_length = 0, dummy = 0):
+        return self.client.ecp_spi_transfer(bytes(command) + bytes(dummy), read_length)
+
+def block_crcs(data, block = VERIFY_BLOCK):
+    return [ zlib.crc32(data[i:i + block]) for i in range(0, len(data), block) ]
+
+class FlashMismatch:
+    def __init__(self, start, end, first, expected, actual):
+        self.start = start # flash address range of the failing blocks
+        self.end = end
+        self.first = first # address of the first differing byte
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return f"{self.start:06x}-{self.end - 1:06x}, first difference at {self.first:06x} ({self.expected:02x} expected, {self.actual:02x} read)"
+
+class SpiFlash:
+    def __init__(self, client, bus = None):
+        self.bus = bus or SpiBus(client)
+
+    def jedec_id(self):
+        return self.bus.transfer([ FLASH_JEDEC_ID ], 3)
+
+    def unique_id(self):
+        return self.bus.transfer([ FLASH_UNIQUE_ID ], 8, dummy = 4)
+
+    def read_status(self):
+        return self.bus.transfer([ FLASH_READ_STATUS ], 1)[0]
+
+    def busy(self):
+        return (self.read_status() & FLASH_BUSY) != 0
+
+    def wait_ready(self, timeout = 1.0):
+        deadline = time.perf_counter() + timeout
+        while self.busy():
+            if time.perf_counter() > deadline:
+                raise TimeoutError("SPI flash stays busy")
+
+    def erase_sector(self, addr):
+        self.bus.transfer([ FLASH_WRITE_ENABLE ])
+        self.bus.transfer([ FLASH_SECTOR_ERASE, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF ])
+        self.wait_ready()
+
+    def program_page(self, addr, data):
+        self.bus.transfer([ FLASH_WRITE_ENABLE ])
+        self.bus.transfer(bytes((FLASH_PAGE_PROGRAM, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF)) + bytes(data))
+        self.wait_ready()
+
+    def program(self, addr, data, callback = None):
+        """Erases the sectors and programs the pages that hold 'data'; 'addr' must be sector aligned.
+           Pages that are all 0xFF are only erased. 'callback' gets the number of bytes done after each sector."""
+        for start in range(0, len(data), SECTOR):
+            self.erase_sector(addr + start)
+            for page in range(start, min(start + SECTOR, len(data)), PAGE):
+                chunk = data[page:page + PAGE]
+                if chunk.count(0xFF) != len(chunk):
+                    self.program_page(addr + page, chunk)
+            if callback:
+                callback(min(start + SECTOR, len(data)))
+
+    def read(self, addr, length):
+        command = [ FLASH_READ, (addr >> 16) & 0xFF, (addr >> 8) & 0xFF, addr & 0xFF ]
+        return self.bus.transfer(command, length)
+
+    def verify(self, addr, image, crcs = None, block = VERIFY_BLOCK, callback = None):
+        """Reads back the flash from 'addr' and compares it with the image. Returns a list of FlashMismatch
+           for each range of consecutive failing blocks; empty when the flash holds the image."""
+        if crcs is None:
+            crcs = block_crcs(image, block)
+        mismatches = []
+        for (idx, crc) in enumerate(crcs):
+            offset = idx * block
+            expected = image[offset:offset + block]
+            actual = self.read(addr + offset, len(expected))
+            if zlib.crc32(actual) != crc:
+                start = addr + offset
+                if mismatches and mismatches[-1].end == start:
+                    mismatches[-1].end = start + len(expected)
+                else:
+                    first = next(i for i in range(len(expected)) if expected[i] != actual[i])
+                    mismatches.append(FlashMismatch(start, start + len(expected), start + first, expected[first], actual[first]))
+            if callback:
+                callback(100. * (idx + 1) / len(crcs))
+        return mismatches
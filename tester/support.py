@@ -1,7 +1,9 @@
 import time, struct, logging, os
 from datetime import datetime
-#from jtag_functions import JtagClient, JtagClientException
-from jtag_direct import JtagClient, JtagClientException
+from jtag_common import JtagClientException
+from daemons import find_daemon
+import _jtag_functions
+import jtag_direct
 
 tester_fpga = 'binaries/ecp5_tester_impl1.bit'
 tester_app  = 'binaries/tester.bin'
@@ -14,6 +16,8 @@ PROG_LOCATION   = 0x0090
 DUT_TO_TESTER   = 0x0094
 TESTER_TO_DUT   = 0x0098
 TEST_STATUS     = 0x009C
+MEMTEST_SEED    = 0x00A0
+MEMTEST_ERRORS  = 0x00A4 # a4-af: error count, first failing address, failing bit mask
 RTC_DATA        = 0x00B0 # b0-bf
 ADC_DATA        = 0x00C0
 
@@ -107,19 +111,38 @@ class Rtc:
         dt = datetime(yr, mon+1, day+1, hr, min, sec)
         return dt
 
-class Tester(JtagClient):
+def open_client(interface):
+    """Returns a JTAG client for the given FTDI interface (1 = A, 2 = B): through the JTAG daemon when one
+       serves the interface, such that the FPGA state and the USB connection outlive the application,
+       and directly over USB otherwise."""
+    if find_daemon(interface):
+        try:
+            return _jtag_functions.JtagClient(interface = interface)
+        except JtagClientException as e:
+            logger.warning(f"JTAG daemon for interface {interface} not usable, opening it directly: {e}")
+    return jtag_direct.JtagClient(url = f'ftdi://ftdi:2232h/{interface}')
+
+class Board:
+    """A board behind one FTDI interface; all JTAG requests go to the client that open_client returned."""
+    def __init__(self, interface):
+        self.client = open_client(interface)
+
+    def __getattr__(self, name):
+        # Only called for what the board itself does not have
+        if name == 'client':
+            raise AttributeError(name)
+        return getattr(self.client, name)
+
+class Tester(Board):
     def __init__(self):
-        JtagClient.__init__(self, url = 'ftdi://ftdi:2232h/2')#, 'localhost', 5000)
-        #JtagClient.__init__(self, 'localhost', 5000)
-        #self.check_daemon()
+        Board.__init__(self, 2)
         if self.ecp_read_id() != 0x41111043:
             raise JtagClientException("ColorLight i5 FPGA module not recognized")
         self.ecp_load_fpga(tester_fpga)
         if self.user_read_id() != 0xdead1541:
             raise JtagClientException("Tester User JTAG not working. (bad ID)")
         self.turn_off_dut()
-        time.sleep(0.2)
-        text = self.user_read_console()
+        text = self.wait_for_console('Tester Module')
         if 'Tester Module' not in text:
             raise JtagClientException("Tester BootROM failure")
         #self.turn_off_dut()
@@ -128,8 +151,7 @@ class Tester(JtagClient):
     def run_i2c_app(self):
         self.user_upload(tester_app, 0x100)
         self.user_run_app(0x100)
-        time.sleep(0.2)
-        text = self.user_read_console()
+        text = self.wait_for_console('Hello I2C')
         if 'Hello I2C' not in text:
             raise JtagClientException("Tester Application failure")
         print(text)
@@ -144,23 +166,21 @@ class Tester(JtagClient):
         TesterADC.report_adcs(self)
 
 #    def user_read_io(self, *args, **kwargs):
-#        ret = JtagClient.user_read_io(self, *args, **kwargs)
+#        ret = self.client.user_read_io(*args, **kwargs)
 #        mem = self.user_read_memory(ADC_DATA + 24, 4)
 #        logger.info(f'-R-> {struct.unpack("<L", mem)}')
 #        logger.info(f'=R=> {self.user_read_debug():08x}')
 #        return ret
 #
 #    def user_write_io(self, *args, **kwargs):
-#        JtagClient.user_write_io(self, *args, **kwargs)
+#        self.client.user_write_io(*args, **kwargs)
 #        mem = self.user_read_memory(ADC_DATA + 24, 4)
 #        logger.info(f'-W-> {struct.unpack("<L", mem)}')
 #        logger.info(f'=W=> {self.user_read_debug():08x}')
 
-class DeviceUnderTest(JtagClient):
+class DeviceUnderTest(Board):
     def __init__(self):
-        JtagClient.__init__(self, url = 'ftdi://ftdi:2232h/1')
-        #JtagClient.__init__(self, 'localhost', 6000)
-        #self.check_daemon()
+        Board.__init__(self, 1)
         self.flash_callback = None
 
     def perform_test(self, test_id, max_time = 10):
@@ -174,6 +194,15 @@ class DeviceUnderTest(JtagClient):
         result = self.user_read_int32(TEST_STATUS)
         return (result, text)
 
+    def perform_test_until_pass(self, test_id, timeout, max_time = 10):
+        """Repeats a test until it passes, or until 'timeout' seconds have passed. Returns the last result."""
+        deadline = time.perf_counter() + timeout
+        while True:
+            (result, text) = self.perform_test(test_id, max_time)
+            if result == 0 or time.perf_counter() > deadline:
+                return (result, text)
+            time.sleep(.1)
+
     def write_current_time(self):
         rtc = Rtc.from_current_time()
         self.user_write_memory(RTC_DATA, rtc)
@@ -194,13 +223,18 @@ class DeviceUnderTest(JtagClient):
         fixed = datetime(1980, 1, 1)
         return dt.timestamp() - fixed.timestamp()
 
-    def ecp_prog_flash(self, name, addr):
+    def ecp_prog_flash(self, name, addr, image = None):
+        # With an ImageInfo from the manifest, the file is not read again
         max_time = 5*120 # 2 minutes
-        file_size = os.stat(name)
-        logger.info(f"Size of file: {file_size.st_size} bytes")
-        pages = (file_size.st_size + 255) // 256 #Callback for every page
-        self.user_upload(name, PROG_BUFFER)
-        self.user_write_int32(PROG_LENGTH, int(file_size.st_size))
+        if image:
+            size = image.size
+            self.user_upload_data(image.data, PROG_BUFFER)
+        else:
+            size = os.stat(name).st_size
+            self.user_upload(name, PROG_BUFFER)
+        logger.info(f"Size of file: {size} bytes")
+        pages = (size + 255) // 256 #Callback for every page
+        self.user_write_int32(PROG_LENGTH, int(size))
         self.user_write_int32(PROG_LOCATION, addr)
 
         self.user_write_int32(TESTER_TO_DUT, 12)
@@ -0,0 +1,192 @@
+# Tone analysis of captured audio; measures a test tone of known frequency.
+#
+# The capture is windowed (Hann) and transformed with a real FFT. The tone is
+# searched close to the frequency that was generated, and its frequency is
+# interpolated between bins. All power within the main lobe of the window
+# around the tone is signal; the main lobes around the harmonics are
+# distortion and the rest, except for DC, is noise.
+import numpy as np
+import queue
+import threading
+
+LOBE = 3 # bins on either side of a peak that belong to it (Hann main lobe is +/-2 bins)
+SEARCH = 4 # bins on either side of the expected frequency to look for the tone
+HARMONICS = 5 # highest harmonic that is counted as distortion
+WELCH_SEGMENT = 2048 # samples per segment for streaming analysis
+WELCH_MIN_SEGMENTS = 2 # segments to average before a tone can be accepted
+
+class ToneResult:
+    def __init__(self, freq, ampl, snr, thdn):
+        self.freq = freq # Hz
+        self.ampl = ampl # peak amplitude, relative to full scale
+        self.snr = snr   # dB, signal to noise excluding harmonics
+        self.thdn = thdn # ratio, total harmonic distortion + noise
+        self.crosstalk = None # dB, level of this tone in the other channel
+
+    def __str__(self):
+        s = f"{self.freq:.1f} Hz, amplitude {self.ampl:.3f}, SNR {self.snr:.1f} dB, THD+N {100 * self.thdn:.3f}%"
+        if self.crosstalk is not None:
+            s += f", crosstalk {self.crosstalk:.1f} dB"
+        return s
+
+def spectrum(wave):
+    window = np.hanning(len(wave))
+    power = np.abs(np.fft.rfft(wave * window)) ** 2
+    # Scales power in a lobe to the square of the peak amplitude of the sine
+    scale = 4.0 / (len(wave) * np.sum(window ** 2))
+    return (power, scale)
+
+def lobe_power(power, k):
+    return np.sum(power[max(k - LOBE, 0):k + LOBE + 1])
+
+def find_peak(power, expected_bin):
+    lo = max(int(round(expected_bin)) - SEARCH, 1)
+    hi = min(int(round(expected_bin)) + SEARCH + 1, len(power) - 1)
+    k = lo + int(np.argmax(power[lo:hi]))
+    # Parabolic interpolation on the log magnitude
+    (a, b, c) = np.log(power[k-1:k+2] + 1e-30)
+    denom = a - 2 * b + c
+    offset = 0.5 * (a - c) / denom if denom != 0 else 0.0
+    return (k, k + offset)
+
+def analyze_power(power, scale, freq, bin_hz):
+    """Measures the tone near 'freq' in a power spectrum."""
+    (k, exact) = find_peak(power, freq / bin_hz)
+
+    signal = lobe_power(power, k)
+    distortion = 0.0
+    for h in range(2, HARMONICS + 1):
+        kh = int(round(h * exact))
+        if kh + LOBE >= len(power):
+            break
+        distortion += lobe_power(power, kh)
+    total = np.sum(power[LOBE + 1:]) # without DC
+    noise = max(total - signal - distortion, 1e-30)
+    rest = max(total - signal, 1e-30)
+
+    return ToneResult(exact * bin_hz, np.sqrt(signal * scale), 10 * np.log10(signal / noise), np.sqrt(rest / signal))
+
+def level_power(power, scale, freq, bin_hz):
+    """Peak amplitude in a power spectrum at exactly 'freq', without searching."""
+    return np.sqrt(lobe_power(power, int(round(freq / bin_hz))) * scale)
+
+def add_crosstalk(results, powers, scale, bin_hz):
+    # Level of each channel's tone in the other channel, relative to the tone itself
+    for (this, other) in ((0, 1), (1, 0)):
+        level = level_power(powers[other], scale, results[this].freq, bin_hz)
+        results[this].crosstalk = 20 * np.log10(max(level, 1e-12) / max(results[this].ampl, 1e-12))
+
+def analyze_tone(wave, freq, samplingFrequency = 48000):
+    """Measures the tone near 'freq' in the wave (float samples, full scale = 1.0)."""
+    (power, scale) = spectrum(wave)
+    return analyze_power(power, scale, freq, samplingFrequency / len(wave))
+
+def capture_channels(data, channels = 2):
+    # Zero-copy view on the interleaved int32 samples, one row per channel
+    samples = np.frombuffer(data, dtype = '<i4')
+    samples = samples[:len(samples) - (len(samples) % channels)]
+    return samples.reshape(-1, channels).T / pow(2.0, 31)
+
+class WelchAnalyzer:
+    """Accumulates the averaged power spectrum (Welch, 50% overlap) of a capture that arrives in blocks."""
+    def __init__(self, channels = 2, segment = WELCH_SEGMENT):
+        self.segment = segment
+        self.hop = segment // 2
+        self.window = np.hanning(segment)
+        self.scale = 4.0 / (segment * np.sum(self.window ** 2))
+        self.pending = np.zeros((channels, 0))
+        self.total = np.zeros((channels, segment // 2 + 1))
+        self.count = 0
+
+    def feed(self, waves):
+        self.pending = np.concatenate((self.pending, waves), axis = 1)
+        n = (self.pending.shape[1] - self.segment) // self.hop + 1
+        if n <= 0:
+            return
+        idx = np.arange(self.segment)[None, :] + self.hop * np.arange(n)[:, None]
+        segments = self.pending[:, idx] * self.window
+        self.total += np.sum(np.abs(np.fft.rfft(segments, axis = 2)) ** 2, axis = 1)
+        self.count += n
+        self.pending = self.pending[:, n * self.hop:]
+
+    def results(self, freqs, samplingFrequency = 48000):
+        if self.count == 0:
+            raise ValueError("Not enough samples for a spectrum")
+        powers = self.total / self.count
+        bin_hz = samplingFrequency / self.segment
+        results = [ analyze_power(power, self.scale, freq, bin_hz) for (power, freq) in zip(powers, freqs) ]
+        if len(results) == 2:
+            add_crosstalk(results, powers, self.scale, bin_hz)
+        return results
+
+def stream_analysis(blocks, freqs, accept = None, samplingFrequency = 48000):
+    """Analyzes capture blocks from a generator on a worker thread, while the next block is being read.
+       Once enough has been read for 'accept' to judge the results so far, the next block is only read
+       when 'accept' returned False for them. Returns the results per channel. An exception of the
+       analysis is raised here."""
+    analyzer = WelchAnalyzer(len(freqs))
+    todo = queue.Queue()
+    verdicts = queue.Queue() # per block: accepted results, None, or the exception of the analysis
+    needed = analyzer.segment + analyzer.hop * (WELCH_MIN_SEGMENTS - 1) # samples for the first judgement
+
+    def worker():
+        try:
+            while True:
+                waves = todo.get()
+                if waves is None:
+                    return
+                analyzer.feed(waves)
+                verdict = None
+                if accept and analyzer.count >= WELCH_MIN_SEGMENTS:
+                    results = analyzer.results(freqs, samplingFrequency)
+                    if accept(results):
+                        verdict = results
+                verdicts.put(verdict)
+        except Exception as e:
+            verdicts.put(e)
+
+    def collect(outstanding):
+        accepted = None
+        for _ in range(outstanding):
+            verdict = verdicts.get()
+            if isinstance(verdict, Exception):
+                raise verdict
+            accepted = accepted or verdict
+        return accepted
+
+    thread = threading.Thread(target = worker, daemon = True)
+    thread.start()
+    accepted = None
+    outstanding = 0
+    samples = 0
+    try:
+        for data in blocks:
+            waves = capture_channels(data, len(freqs))
+            todo.put(waves)
+            outstanding += 1
+            samples += waves.shape[1]
+            if accept and samples >= needed:
+                accepted = collect(outstanding)
+                outstanding = 0
+                if accepted:
+                    break
+    finally:
+        todo.put(None)
+    accepted = collect(outstanding) or accepted
+    thread.join()
+    if accepted:
+        return accepted
+    return analyzer.results(freqs, samplingFrequency)
+
+def check_tone(result, freq, min_ampl, tolerance = 5.0, min_snr = None, max_crosstalk = None):
+    """Returns a list of reasons why the tone does not meet the limits; empty when it does."""
+    reasons = []
+    if result.ampl < min_ampl:
+        reasons.append(f"amplitude {result.ampl:.3f} below {min_ampl:.3f}")
+    if abs(result.freq - freq) > tolerance:
+        reasons.append(f"peak at {result.freq:.1f} Hz instead of {freq:.0f} Hz")
+    if min_snr is not None and result.snr < min_snr:
+        reasons.append(f"SNR {result.snr:.1f} dB below {min_snr:.0f} dB")
+    if max_crosstalk is not None and result.crosstalk is not None and result.crosstalk > max_crosstalk:
+        reasons.append(f"crosstalk {result.crosstalk:.1f} dB above {max_crosstalk:.0f} dB")
+    return reasons
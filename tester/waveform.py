@@ -0,0 +1,56 @@
+# Test signal synthesis for the audio tests.
+#
+# Signals are generated with NumPy in one go and returned as interleaved
+# little endian int32 samples, ready to be uploaded to the audio DMA buffer.
+# They are cached by their parameters, so each one is only computed once.
+# The signals that the tests use are defined here as well, such that the
+# analysis can take the expected frequencies from the same definition.
+import functools
+import numpy as np
+
+SAMPLE_RATE = 48000
+FULL_SCALE = pow(2.0, 31)
+
+def interleave(waves):
+    """Converts a (channels x samples) array, full scale = 1.0, to interleaved int32 sample bytes."""
+    return (np.asarray(waves).T * FULL_SCALE).astype('<i4').tobytes()
+
+@functools.lru_cache(maxsize = None)
+def tones(freqs, samples, level = 0.9, rate = SAMPLE_RATE):
+    """One sine per channel, with the frequencies given in channel order."""
+    t = np.arange(samples) / rate
+    return interleave(level * np.sin(2 * np.pi * np.array(freqs)[:, None] * t))
+
+@functools.lru_cache(maxsize = None)
+def multitone(freqs, samples, level = 0.9, channels = 1, rate = SAMPLE_RATE):
+    """Sum of sines of equal amplitude, with a total peak of at most 'level', on all channels."""
+    t = np.arange(samples) / rate
+    wave = (level / len(freqs)) * np.sum(np.sin(2 * np.pi * np.array(freqs)[:, None] * t), axis = 0)
+    return interleave(np.tile(wave, (channels, 1)))
+
+@functools.lru_cache(maxsize = None)
+def sweep(start, stop, samples, level = 0.9, channels = 1, rate = SAMPLE_RATE):
+    """Exponential sine sweep from 'start' to 'stop' Hz, on all channels."""
+    t = np.arange(samples) / rate
+    duration = samples / rate
+    k = np.log(stop / start)
+    wave = level * np.sin(2 * np.pi * start * duration / k * (np.exp(t * k / duration) - 1))
+    return interleave(np.tile(wave, (channels, 1)))
+
+class TestSignal:
+    """A looped test signal, with one tone per channel. The number of samples must hold a whole number of periods of each tone."""
+    def __init__(self, freqs, samples, level):
+        self.freqs = tuple(freqs)
+        self.samples = samples
+        self.level = level
+
+    @property
+    def data(self):
+        return tones(self.freqs, self.samples, self.level)
+
+    @property
+    def size(self):
+        return self.samples * 4 * len(self.freqs)
+
+AUDIO_LOOPBACK = TestSignal((1000., 750.), 192, 0.9) # Left, Right
+SPEAKER        = TestSignal((250., 500.), 192, 0.99)
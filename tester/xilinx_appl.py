@@ -4,6 +4,10 @@ import time
 import logging
 import struct
 import os
+from iocmd import io_read_command, io_write_command
+from console import decode_console
+from bulk import mapped_file, chunks, stack_data
+from regmap import RegisterMap
 
 # create logger
 logger = logging.getLogger('JTAG')
@@ -78,6 +82,7 @@ class JtagClient:
         self.jtag.configure(url)
         self.jtag.reset()
         self._reverse = None
+        self.registers = None
 
     def jtag_clocks(self, clocks):
         cmd = bytearray(3)
@@ -137,18 +142,13 @@ class JtagClient:
         # Program
         logger.info("programming..");
         self.jtag.write_ir(BitSequence(XILINX_CFG_IN, False, 6))
-        with open(filename, "rb") as f:
+        with mapped_file(filename) as view:
             self.jtag.change_state('shift_dr')
-            while(True):
-                buffer = f.read(16384)
-                if len(buffer) <= 0:
-                    break
-
+            for (_offset, buffer) in chunks(view):
                 olen = len(buffer)-1
-                cmd = bytearray((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
+                cmd = bytes((Ftdi.WRITE_BYTES_NVE_MSB, olen & 0xff,
                           (olen >> 8) & 0xff))
-                cmd.extend(buffer)
-                self.jtag._ctrl._stack_cmd(cmd)
+                stack_data(self.jtag, cmd, buffer)
 
         self.jtag.change_state('update_dr')
         self.jtag.go_idle()
@@ -256,37 +256,24 @@ class JtagClient:
     
     def user_read_console(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 10, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
+        text = decode_console(raw, 1)
         if do_print:
             logger.info(text)
         return text
     
     def user_read_console2(self, do_print = False):
         raw = self.read_fifo(expected = 1000, cmd = 11, stopOnEmpty = True)
-        text = bytearray(len(raw))
-        for i in range(len(text)):
-            if raw[i] < 0x20 and raw[i] != 0x0a:
-                text[i] = 0x3f
-            text[i] = raw[i] & 0x7F
-        text = text.decode("utf-8")
+        text = decode_console(raw, 2)
         if do_print:
             logger.info(text)
         return text
     
     def user_upload(self, name, addr):
-        bytes_read = 0
-        with open(name, "rb") as fi:
+        with mapped_file(name) as view:
             logger.info(f"Uploading {name} to address {addr:08x}")
-            while(True):
-                buffer = fi.read(16384)
-                if len(buffer) <= 0:
-                    break
-                bytes_read += len(buffer)
-                self.user_write_memory(addr, buffer + b'\x00\x00\x00\x00\x00\x00\x00\x00')
-                addr += 16384
+            bytes_read = len(view)
+            for (offset, chunk) in chunks(view):
+                self.user_write_memory(addr + offset, chunk, padding = 8)
             logger.info(f"Uploaded {bytes_read:06x} bytes.")
 
         if bytes_read == 0:
@@ -324,17 +311,17 @@ class JtagClient:
         if reset:
             self.user_set_outputs(0x80) # Unreset
     
-    def user_write_memory(self, addr, buffer):
+    def user_write_memory(self, addr, buffer, padding = 0):
         addrbytes = struct.pack("<L", addr)
         command = bytearray([ addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6, addrbytes[3], 7, 0x80, 0x01])
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.set_user_ir(6)
-        olen = len(buffer)-1
-        cmd = bytearray((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
+        # 'padding' zero bytes are sent after the buffer
+        olen = len(buffer) + padding - 1
+        cmd = bytes((Ftdi.WRITE_BYTES_NVE_LSB, olen & 0xff,
                     (olen >> 8) & 0xff))
-        cmd.extend(buffer)
-        self.jtag._ctrl._stack_cmd(cmd)
+        stack_data(self.jtag, cmd, buffer, bytes(padding))
         self.jtag.go_idle()
     
     def user_read_memory(self, addr, len):
@@ -367,23 +354,31 @@ class JtagClient:
         return struct.unpack("<L", valbytes)[0]
 
     def user_write_io(self, addr, bytes):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for b in bytes:
-            command += struct.pack("BB", b, 0x0f)
+        command = io_write_command(addr, bytes)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         self.jtag.go_idle()
 
     def user_read_io(self, addr, len):
-        addrbytes = struct.pack("<L", addr)
-        command = struct.pack("<BBBBBB", addrbytes[0], 4, addrbytes[1], 5, addrbytes[2], 6)
-        for i in range(len):
-            command += b'\x00\x0d'
+        command = io_read_command(addr, len)
         self.set_user_ir(5)
         self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
         return self.read_fifo(len)
 
+    def user_queue_io(self, ops):
+        """Sends a list of (addr, bytes) writes of I/O registers as one command."""
+        command = bytearray()
+        for (addr, data) in ops:
+            io_write_command(addr, data, command)
+        self.set_user_ir(5)
+        self.jtag.shift_and_update_register(BitSequence(bytes_ = command))
+        self.jtag.go_idle()
+
+    def register_map(self, host_owned = ()):
+        if not self.registers:
+            self.registers = RegisterMap(self, host_owned)
+        return self.registers
+
 DDRIO_OFFSET         = 0x100100
 DDR_ADDR_LOW         = DDRIO_OFFSET + 0
 DDR_ADDR_HIGH        = DDRIO_OFFSET + 1
@@ -485,10 +480,13 @@ def calibrateDQS(j):
             if pos:
                 j.user_write_io(DDR_READ_DELAY, [dly])
                 print(f'Calibrated to idelay {pos} and read_delay {dly} with {bs} bitslips')
-                for i in range(pos):
-                    j.user_write_io(DDR_DELAY_SEL_DQS, b'\x03')
-                    j.user_write_io(DDR_DELAY_SEL_DATA_0, b'\xff')
-                    j.user_write_io(DDR_DELAY_SEL_DATA_1, b'\xff')
+                # All delay steps are sent in one go
+                regs = j.register_map()
+                with regs:
+                    for i in range(pos):
+                        regs.write(DDR_DELAY_SEL_DQS, b'\x03')
+                        regs.write(DDR_DELAY_SEL_DATA_0, b'\xff')
+                        regs.write(DDR_DELAY_SEL_DATA_1, b'\xff')
 
                 j.user_write_int32(0x104, 0xABCDEF55)
                 j.user_write_int32(0x100, 0x87654321)